@@ -1,17 +1,32 @@
+import atexit
+import base64
+import csv
 import collections
 import datetime
 import isodate
+import itertools
 import json
 import os
 import PIL.Image
 import rawes
 import re
 import requests
+import shutil
+import six
+import sqlite3
 import sys
+import threading
 import time
 import getopt
+import glob
+import hashlib
+import heapq
 import yaml
+import zipfile
+import zlib
 import logging
+import math
+import multiprocessing
 
 from dateutil import tz
 from dateutil.parser import parse
@@ -21,12 +36,15 @@ from distutils.util import strtobool
 from django.conf import settings
 from django.core import management
 from django.conf.urls import url
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified, StreamingHttpResponse
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
 from django.views.decorators.csrf import csrf_exempt
 
 from io import BytesIO
 
+from multiprocessing.pool import ThreadPool
+
 from markdown2 import markdown_path
 
 from pycsw import server
@@ -46,11 +64,18 @@ from mapproxy.wsgiapp import MapProxyApp
 
 from shapely.geometry import box
 
+from sqlalchemy import create_engine, text
+
+from six.moves import queue
 from six.moves.urllib_parse import urlparse, unquote as url_unquote, urlencode
 
 from rawes.elastic_exception import ElasticException
 
-netlocs_dic = {}
+try:
+    import numpy
+except ImportError:
+    # Image checks fall back to python when NumPy is not installed.
+    numpy = None
 
 __version__ = 0.2
 
@@ -65,13 +90,98 @@ REGISTRY_MAPPING_DIST_ERR_PCT = os.getenv('REGISTRY_MAPPING_DIST_ERR_PCT', 0.025
 REGISTRY_SEARCH_URL = os.getenv('REGISTRY_SEARCH_URL', 'http://127.0.0.1:9200')
 REGISTRY_SEARCH_USERNAME = os.getenv('REGISTRY_SEARCH_USERNAME')
 REGISTRY_SEARCH_PASSWORD = os.getenv('REGISTRY_SEARCH_PASSWORD')
+REGISTRY_SEARCH_POOL_SIZE = int(os.getenv('REGISTRY_SEARCH_POOL_SIZE', '10'))
+REGISTRY_SEARCH_CONNECT_TIMEOUT = float(os.getenv('REGISTRY_SEARCH_CONNECT_TIMEOUT', '5'))
+REGISTRY_SEARCH_READ_TIMEOUT = float(os.getenv('REGISTRY_SEARCH_READ_TIMEOUT', '30'))
+REGISTRY_SEARCH_MAX_RETRIES = int(os.getenv('REGISTRY_SEARCH_MAX_RETRIES', '0'))
+REGISTRY_SEARCH_VERSION_TTL = int(os.getenv('REGISTRY_SEARCH_VERSION_TTL', '300'))
+# Search responses cache: empty (disabled), memory (per process) or sqlite
+# (shared by the processes of a host through REGISTRY_SEARCH_CACHE_PATH).
+REGISTRY_SEARCH_CACHE = os.getenv('REGISTRY_SEARCH_CACHE', '')
+REGISTRY_SEARCH_CACHE_SIZE = int(os.getenv('REGISTRY_SEARCH_CACHE_SIZE', '1000'))
+REGISTRY_SEARCH_CACHE_TTL = int(os.getenv('REGISTRY_SEARCH_CACHE_TTL', '300'))
+REGISTRY_SEARCH_CACHE_PATH = os.getenv('REGISTRY_SEARCH_CACHE_PATH', '/tmp/registry_search_cache.db')
+# JSON codec of search responses and Elasticsearch replies: auto, orjson, ujson or json.
+REGISTRY_JSON_CODEC = os.getenv('REGISTRY_JSON_CODEC', 'auto')
+# Time Elasticsearch 2.x keeps the scroll context of a cursor search alive.
+REGISTRY_SEARCH_SCROLL = os.getenv('REGISTRY_SEARCH_SCROLL', '1m')
+# Documents requested from Elasticsearch per page of an export.
+REGISTRY_EXPORT_PAGE_SIZE = int(os.getenv('REGISTRY_EXPORT_PAGE_SIZE', '1000'))
+# Heatmaps with an explicit grid level are computed in tiles of
+# REGISTRY_HEATMAP_TILE_CELLS x REGISTRY_HEATMAP_TILE_CELLS cells cached per catalog.
+REGISTRY_HEATMAP_CACHE_SIZE = int(os.getenv('REGISTRY_HEATMAP_CACHE_SIZE', '2000'))
+REGISTRY_HEATMAP_CACHE_TTL = int(os.getenv('REGISTRY_HEATMAP_CACHE_TTL', '300'))
+REGISTRY_HEATMAP_TILE_CELLS = int(os.getenv('REGISTRY_HEATMAP_TILE_CELLS', '32'))
+REGISTRY_HEATMAP_MAX_TILES = int(os.getenv('REGISTRY_HEATMAP_MAX_TILES', '64'))
+# Time histogram and categories facets of searches without filters, or only
+# filtered by a start date, answered from per catalog rollups of daily counts.
+REGISTRY_ROLLUPS = strtobool(os.getenv('REGISTRY_ROLLUPS', 'False'))
+REGISTRY_ROLLUP_TTL = int(os.getenv('REGISTRY_ROLLUP_TTL', '300'))
+# Seconds after a rebuild during which writes do not start another one.
+REGISTRY_ROLLUP_REBUILD_INTERVAL = float(os.getenv('REGISTRY_ROLLUP_REBUILD_INTERVAL', '5'))
+REGISTRY_ROLLUP_MAX_CATEGORIES = int(os.getenv('REGISTRY_ROLLUP_MAX_CATEGORIES', '1000'))
+REGISTRY_CATALOG_CACHE_TTL = int(os.getenv('REGISTRY_CATALOG_CACHE_TTL', '60'))
+# Seconds a catalog missing from elasticsearch is answered as missing without
+# reading _aliases again.
+REGISTRY_CATALOG_MISS_TTL = int(os.getenv('REGISTRY_CATALOG_MISS_TTL', '5'))
+REGISTRY_INDEX_BATCH_SIZE = int(os.getenv('REGISTRY_INDEX_BATCH_SIZE', '500'))
+REGISTRY_INDEX_FLUSH_INTERVAL = float(os.getenv('REGISTRY_INDEX_FLUSH_INTERVAL', '2'))
+REGISTRY_INDEX_MAX_INFLIGHT = int(os.getenv('REGISTRY_INDEX_MAX_INFLIGHT', '2'))
+REGISTRY_INDEX_MAX_FAILED = int(os.getenv('REGISTRY_INDEX_MAX_FAILED', '10000'))
+# Lines of check_layers output applied by each request of the reliability command.
+REGISTRY_RELIABILITY_BATCH_SIZE = int(os.getenv('REGISTRY_RELIABILITY_BATCH_SIZE', '500'))
+# If REGISTRY_INDEX_FLUSH_ON_REQUEST is True, records queued by a CSW-T request
+# are sent to elasticsearch before the response is returned.
+REGISTRY_INDEX_FLUSH_ON_REQUEST = strtobool(os.getenv('REGISTRY_INDEX_FLUSH_ON_REQUEST', 'True'))
 REGISTRY_DATABASE_URL = os.getenv('REGISTRY_DATABASE_URL', 'sqlite:////tmp/registry.db')
-REGISTRY_MAXRECORDS_PER_NETLOC = int(os.getenv('REGISTRY_MAXRECORDS_PER_NETLOC', '3600'))
+REGISTRY_DATABASE_POOL_SIZE = int(os.getenv('REGISTRY_DATABASE_POOL_SIZE', '10'))
+REGISTRY_DATABASE_MAX_OVERFLOW = int(os.getenv('REGISTRY_DATABASE_MAX_OVERFLOW', '10'))
+REGISTRY_DATABASE_POOL_RECYCLE = int(os.getenv('REGISTRY_DATABASE_POOL_RECYCLE', '3600'))
+# Layers checked at the same time by check_layers, requests sent at the same time to
+# each remote server, requests per second to each server (0 disables it) and seconds
+# before a request to a server is abandoned.
+REGISTRY_CHECK_WORKERS = int(os.getenv('REGISTRY_CHECK_WORKERS', '20'))
+REGISTRY_CHECK_NETLOC_CONCURRENCY = int(os.getenv('REGISTRY_CHECK_NETLOC_CONCURRENCY', '2'))
+REGISTRY_CHECK_NETLOC_RATE = float(os.getenv('REGISTRY_CHECK_NETLOC_RATE', '2'))
+REGISTRY_CHECK_TIMEOUT = int(os.getenv('REGISTRY_CHECK_TIMEOUT', '30'))
+# Zip file where check_layers stores the MapProxy configuration of each layer.
+REGISTRY_CHECK_ARCHIVE = os.getenv('REGISTRY_CHECK_ARCHIVE', '')
+# Hours between checks of a layer scheduled by schedule_checks: failing layers are
+# checked every REGISTRY_CHECK_MIN_INTERVAL, fully reliable layers every
+# REGISTRY_CHECK_MAX_INTERVAL. At most REGISTRY_CHECK_NETLOC_BUDGET checks of the
+# layers of each remote server are made per day.
+REGISTRY_CHECK_MIN_INTERVAL = float(os.getenv('REGISTRY_CHECK_MIN_INTERVAL', '24'))
+REGISTRY_CHECK_MAX_INTERVAL = float(os.getenv('REGISTRY_CHECK_MAX_INTERVAL', '720'))
+REGISTRY_CHECK_NETLOC_BUDGET = int(os.getenv('REGISTRY_CHECK_NETLOC_BUDGET', '500'))
+# Fraction of the pixels of a layer image with its lightest (blank) or darkest
+# value above which the image fails check_image, and the minimum entropy in
+# bits of its grayscale histogram (0 disables it).
+REGISTRY_CHECK_BLANK_FRACTION = float(os.getenv('REGISTRY_CHECK_BLANK_FRACTION', '0.9983'))
+REGISTRY_CHECK_MIN_ENTROPY = float(os.getenv('REGISTRY_CHECK_MIN_ENTROPY', '0'))
 REGISTRY_CSW_MAX_RECORDS = int(os.getenv('REGISTRY_CSW_MAX_RECORDS', '1000'))
+REGISTRY_REINDEX_WORKERS = int(os.getenv('REGISTRY_REINDEX_WORKERS', multiprocessing.cpu_count()))
+REGISTRY_REINDEX_SENDERS = int(os.getenv('REGISTRY_REINDEX_SENDERS', '2'))
+REGISTRY_REINDEX_CHECKPOINT_DIR = os.getenv('REGISTRY_REINDEX_CHECKPOINT_DIR', '/tmp')
+# Seconds to wait for the force merge of a rebuilt catalog index, 0 waits without limit.
+REGISTRY_REINDEX_MERGE_TIMEOUT = float(os.getenv('REGISTRY_REINDEX_MERGE_TIMEOUT', '0'))
+REGISTRY_MAPPROXY_CACHE_SIZE = int(os.getenv('REGISTRY_MAPPROXY_CACHE_SIZE', '500'))
+# Estimated size, in MB, of the configurations of cached MapProxy apps above
+# which they are evicted. 0 disables it.
+REGISTRY_MAPPROXY_CACHE_MEMORY = int(os.getenv('REGISTRY_MAPPROXY_CACHE_MEMORY', '0'))
 REGISTRY_LOG_FILE_PATH = os.getenv('REGISTRY_LOG_FILE_PATH', '/tmp/registry.log')
 REGISTRY_LOG_LEVEL = os.getenv('REGISTRY_LOG_LEVEL', 'DEBUG')
 PYCSW_LOG_LEVEL = os.getenv('PYCSW_LOG_LEVEL', 'DEBUG')
 MAPPROXY_CACHE_DIR = os.getenv('MAPPROXY_CACHE_DIR', '/tmp')
+# Tile storage for the per-layer MapProxy caches: file, sqlite, mbtiles or
+# geopackage under MAPPROXY_CACHE_DIR. Empty disables storage.
+REGISTRY_MAPPROXY_CACHE_TYPE = os.getenv('REGISTRY_MAPPROXY_CACHE_TYPE', '')
+REGISTRY_MAPPROXY_CACHE_TTL = int(os.getenv('REGISTRY_MAPPROXY_CACHE_TTL', '0'))
+REGISTRY_MAPPROXY_LAYER_CACHE_MB = int(os.getenv('REGISTRY_MAPPROXY_LAYER_CACHE_MB', '0'))
+REGISTRY_MAPPROXY_CACHE_QUOTA_MB = int(os.getenv('REGISTRY_MAPPROXY_CACHE_QUOTA_MB', '0'))
+REGISTRY_MAPPROXY_CACHE_PRUNE_INTERVAL = int(os.getenv('REGISTRY_MAPPROXY_CACHE_PRUNE_INTERVAL', '0'))
+# Seconds before a stored thumbnail is rendered again in the background.
+REGISTRY_THUMBNAIL_TTL = int(os.getenv('REGISTRY_THUMBNAIL_TTL', '86400'))
+REGISTRY_THUMBNAIL_WORKERS = int(os.getenv('REGISTRY_THUMBNAIL_WORKERS', '8'))
 # If MAPPROXY_ERROR_IMAGES is True, wms requests with source errors will return
 # an image with the errors printed within it and a 200 status code. Otherwise,
 # an xml exception and 500 status code will be returned.
@@ -321,6 +431,8 @@ def csw_view(request, catalog=None):
     csw = server.Csw(PYCSW, env)
     csw.orm = 'sqlalchemy'
     status, content = csw.dispatch_wsgi()
+    if catalog and REGISTRY_INDEX_FLUSH_ON_REQUEST:
+        INDEX_QUEUE.flush()
     status_code = int(status[0:3])
     response = HttpResponse(content,
                             content_type=csw.contenttype,
@@ -346,11 +458,22 @@ def delete_index(catalog, es=None):
     if not es:
         es, version = es_connect(url=REGISTRY_SEARCH_URL)
 
+    message, status = 'Catalog does not exist!', 404
+    indices = catalog_indices(catalog, es)
+    # Failed or interrupted rebuilds leave versioned indices without the catalog alias.
+    for version in catalog_versions(catalog, es):
+        index = catalog_index_name(catalog, version)
+        if index not in indices:
+            indices.append(index)
     try:
-        es.delete(catalog)
-        message, status = 'Catalog {0} removed succesfully'.format(catalog), 200
+        for index in indices:
+            es.delete(index)
+        if indices:
+            message, status = 'Catalog {0} removed succesfully'.format(catalog), 200
     except ElasticException:
-        message, status = 'Catalog does not exist!', 404
+        pass
+    invalidate_catalogs()
+    invalidate_search_cache(catalog)
 
     return message, status
 
@@ -442,37 +565,433 @@ def record_to_dict(record):
     return record_dict
 
 
-def check_index_exists(catalog, es=None):
+# Catalog names per elasticsearch url, refreshed from _aliases every
+# REGISTRY_CATALOG_CACHE_TTL seconds or when a catalog is created or removed.
+CATALOG_CACHE = {}
+CATALOG_CACHE_LOCK = threading.Lock()
+# Time catalogs were last found missing, by elasticsearch url and catalog.
+MISSING_CATALOGS = {}
+
+
+def list_catalogs(es=None, refresh=False):
+    """Return the list of catalogs, using the cached _aliases response when fresh.
+    """
+    now = time.time()
+    with CATALOG_CACHE_LOCK:
+        cached = CATALOG_CACHE.get(REGISTRY_SEARCH_URL)
+    if not refresh and cached is not None and now - cached['updated'] <= REGISTRY_CATALOG_CACHE_TTL:
+        return cached['catalogs']
+
     if es is None:
         es, version = es_connect(url=REGISTRY_SEARCH_URL)
 
-    result = False
-    indices = es.get('_aliases').keys()
-    if catalog in indices:
-        result = True
+    catalogs = catalogs_from_aliases(es.get('_aliases'))
+    with CATALOG_CACHE_LOCK:
+        CATALOG_CACHE[REGISTRY_SEARCH_URL] = {'catalogs': catalogs, 'updated': now}
+
+    return catalogs
+
+
+def catalogs_from_aliases(aliases):
+    # Catalogs are aliases of versioned indices. Indices created before
+    # versioning are catalogs themselves.
+    catalogs = []
+    for index, info in aliases.items():
+        for catalog in list(info.get('aliases', {}).keys()) or [index]:
+            if catalog not in catalogs:
+                catalogs.append(catalog)
+
+    return catalogs
+
+
+def invalidate_catalogs():
+    with CATALOG_CACHE_LOCK:
+        CATALOG_CACHE.clear()
+        MISSING_CATALOGS.clear()
+
+
+def catalog_recently_missing(catalog):
+    with CATALOG_CACHE_LOCK:
+        missed = MISSING_CATALOGS.get((REGISTRY_SEARCH_URL, catalog))
+    return missed is not None and time.time() - missed <= REGISTRY_CATALOG_MISS_TTL
+
+
+def remember_missing_catalog(catalog):
+    with CATALOG_CACHE_LOCK:
+        # Unknown names come from clients, keep the expired ones from piling up.
+        if len(MISSING_CATALOGS) >= 1000:
+            MISSING_CATALOGS.clear()
+        MISSING_CATALOGS[(REGISTRY_SEARCH_URL, catalog)] = time.time()
+
+
+def check_index_exists(catalog, es=None):
+    if catalog in list_catalogs(es):
+        return True
+    if catalog_recently_missing(catalog):
+        return False
+
+    # The catalog may have been created by another process since the last refresh.
+    if catalog in list_catalogs(es, refresh=True):
+        return True
+    remember_missing_catalog(catalog)
+    return False
+
+
+def catalog_index_name(catalog, index_version):
+    return '{0}_v{1}'.format(catalog, index_version)
+
+
+def catalog_indices(catalog, es):
+    """Return the concrete indices behind a catalog, read from elasticsearch.
+    """
+    indices = []
+    for index, info in es.get('_aliases').items():
+        if index == catalog or catalog in info.get('aliases', {}):
+            indices.append(index)
+
+    return indices
+
+
+def catalog_versions(catalog, es):
+    """Return the versions of every versioned index of a catalog, aliased or not.
+    """
+    pattern = re.compile('^{0}_v(\\d+)$'.format(re.escape(catalog)))
+    versions = []
+    for index in es.get('_aliases').keys():
+        matcher = pattern.match(index)
+        if matcher:
+            versions.append(int(matcher.group(1)))
 
-    return result
+    return sorted(versions)
 
 
-def create_index(catalog, es=None, version=None):
+def create_index(catalog, es=None, version=None, index_version=1, settings=None, alias=True):
+    """Create the versioned index of a catalog, by default behind the catalog alias.
+    """
     if es is None:
         es, version = es_connect(url=REGISTRY_SEARCH_URL)
 
     mapping = es_mapping(version)
-    es.put(catalog, data=mapping)
+    if settings:
+        mapping['settings'] = settings
+    if alias:
+        mapping['aliases'] = {catalog: {}}
+    es.put(catalog_index_name(catalog, index_version), data=mapping)
+    invalidate_catalogs()
+    invalidate_search_cache(catalog)
 
     return 'Catalog {0} created succesfully'.format(catalog)
 
 
-def es_connect(url):
-    LOGGER.debug('Connecting to elasticsearch at {0}'.format(url))
+def estimate_size(obj):
+    """Return the approximate size in bytes of nested dicts, lists and scalars.
+    """
+    size, pending, seen = 0, [obj], set()
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set)):
+            pending.extend(item)
+
+    return size
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with optional expiration.
+
+       Entries are evicted when maxsize is reached, when they are older than
+       ttl seconds and, with maxweight, while the summed weigh(value) of the
+       entries is above it.
+    """
+    def __init__(self, maxsize=128, ttl=None, maxweight=0, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+                self.weight -= entry[2]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        weight = self.weigh(value) if self.weigh else 0
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (value, time.time(), weight)
+            self.weight += weight
+            while len(self.entries) > self.maxsize or (
+                    self.maxweight and self.weight > self.maxweight and len(self.entries) > 1):
+                self.weight -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def invalidate(self, predicate):
+        """Remove the entries whose key matches predicate.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'weight': self.weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def load_json_codec(name=REGISTRY_JSON_CODEC):
+    """Return the (dumps, loads) functions of a JSON codec, both working with text.
+       auto picks the first installed of orjson and ujson, and falls back to json.
+    """
+    candidates = ['orjson', 'ujson'] if name == 'auto' else [name]
+    for candidate in candidates:
+        try:
+            if candidate == 'orjson':
+                import orjson
+                return lambda obj: orjson.dumps(obj, default=str).decode('utf-8'), orjson.loads
+            if candidate == 'ujson':
+                import ujson
+                return lambda obj: ujson.dumps(obj, escape_forward_slashes=False), ujson.loads
+        except ImportError:
+            if name != 'auto':
+                LOGGER.warn('JSON codec {0} is not installed, using json'.format(name))
+
+    return json.dumps, json.loads
+
+
+JSON_DUMPS, JSON_LOADS = load_json_codec()
+
+
+class RawJSON(six.text_type):
+    """A JSON document kept as received from Elasticsearch, sent to clients without decoding it.
+    """
+
+
+def json_dumps(obj):
+    if isinstance(obj, RawJSON):
+        return six.text_type(obj)
+
+    return JSON_DUMPS(obj)
+
+
+class MemorySearchCache(object):
+    """Search responses and catalog generations kept by the process.
+    """
+    def __init__(self, maxsize=REGISTRY_SEARCH_CACHE_SIZE, ttl=REGISTRY_SEARCH_CACHE_TTL):
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def generation(self, catalog):
+        return self.generations.get(catalog, 0)
+
+    def bump(self, catalog):
+        with self.lock:
+            self.generations[catalog] = self.generations.get(catalog, 0) + 1
+
+
+class SQLiteSearchCache(object):
+    """Search responses and catalog generations stored in a sqlite file, so
+       every registry process of the host sees the same entries and a write
+       in one process invalidates the responses cached by the others.
+    """
+    def __init__(self, path=REGISTRY_SEARCH_CACHE_PATH, maxsize=REGISTRY_SEARCH_CACHE_SIZE,
+                 ttl=REGISTRY_SEARCH_CACHE_TTL):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            connection.execute('CREATE TABLE IF NOT EXISTS generations '
+                               '(catalog TEXT PRIMARY KEY, generation INTEGER)')
+
+    def connection(self):
+        # sqlite connections can not be shared between threads.
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        with self.connection() as connection:
+            row = connection.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            connection.execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+
+        return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, value, now, now))
+            connection.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries '
+                               'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def generation(self, catalog):
+        row = self.connection().execute('SELECT generation FROM generations WHERE catalog = ?',
+                                        (catalog,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, catalog):
+        with self.connection() as connection:
+            connection.execute('INSERT OR IGNORE INTO generations VALUES (?, 0)', (catalog,))
+            connection.execute('UPDATE generations SET generation = generation + 1 WHERE catalog = ?', (catalog,))
+
+
+SEARCH_CACHES = {}
+
+
+def get_search_cache():
+    """Return the search cache selected by REGISTRY_SEARCH_CACHE, or None when disabled.
+    """
+    if not REGISTRY_SEARCH_CACHE:
+        return None
+    cache = SEARCH_CACHES.get(REGISTRY_SEARCH_CACHE)
+    if cache is None:
+        cache = SQLiteSearchCache() if REGISTRY_SEARCH_CACHE == 'sqlite' else MemorySearchCache()
+        SEARCH_CACHES[REGISTRY_SEARCH_CACHE] = cache
+
+    return cache
+
+
+def invalidate_search_cache(catalog):
+    """Invalidate the responses cached for a catalog and for searches over every catalog.
+    """
+    cache = get_search_cache()
+    if cache is not None:
+        cache.bump(catalog)
+        cache.bump('*')
+    HEATMAP_TILES.invalidate(lambda key: key[0] in (catalog, '*'))
+    with ROLLUPS_LOCK:
+        SEARCH_GENERATIONS[catalog] += 1
+        SEARCH_GENERATIONS['*'] += 1
+
+
+# Writes to each catalog ('*' for all of them) seen by the process.
+SEARCH_GENERATIONS = collections.Counter()
+
+
+def search_generation(key):
+    """Return the generation of a catalog, changed by the writes of the process and,
+       when the search cache is shared, by the writes of the other processes.
+    """
+    cache = get_search_cache()
+
+    return SEARCH_GENERATIONS[key], cache.generation(key) if cache is not None else 0
+
+
+# Elasticsearch clients shared by every thread of the process, keyed by
+# url and credentials. Each entry keeps the cached server version.
+ES_CLIENTS = {}
+ES_CLIENTS_LOCK = threading.Lock()
+
+
+def es_client(url, read_timeout=REGISTRY_SEARCH_READ_TIMEOUT):
+    """Return the pooled rawes client for url, creating it on first use.
+       Requests that may take longer than a search use a client with their own
+       read_timeout, None waits without limit.
+    """
+    auth = None
     if REGISTRY_SEARCH_USERNAME is not None and REGISTRY_SEARCH_PASSWORD is not None:
-        es = rawes.Elastic(url, auth=(REGISTRY_SEARCH_USERNAME, REGISTRY_SEARCH_PASSWORD))
-    else:
-        es = rawes.Elastic(url)
-    version = es.get('')['version']['number']
+        auth = (REGISTRY_SEARCH_USERNAME, REGISTRY_SEARCH_PASSWORD)
+    key = (url, auth, read_timeout)
+
+    with ES_CLIENTS_LOCK:
+        entry = ES_CLIENTS.get(key)
+        if entry is None:
+            LOGGER.debug('Connecting to elasticsearch at {0}'.format(url))
+            timeout = (REGISTRY_SEARCH_CONNECT_TIMEOUT, read_timeout)
+            if auth is not None:
+                es = rawes.Elastic(url, timeout=timeout, auth=auth, json_decoder=JSON_LOADS)
+            else:
+                es = rawes.Elastic(url, timeout=timeout, json_decoder=JSON_LOADS)
+
+            # Keep-alive connections, sized for the number of worker threads.
+            for connection in es.connection_pool.connections:
+                session = getattr(connection, 'session', None)
+                if session is None:
+                    continue
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=REGISTRY_SEARCH_POOL_SIZE,
+                                                        max_retries=REGISTRY_SEARCH_MAX_RETRIES)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+            entry = {'es': es, 'version': None, 'version_checked': 0}
+            ES_CLIENTS[key] = entry
+
+    return entry
+
+
+def es_connect(url):
+    entry = es_client(url)
+    es = entry['es']
+
+    # The version probe is only repeated when the cached value expires.
+    now = time.time()
+    if entry['version'] is None or now - entry['version_checked'] > REGISTRY_SEARCH_VERSION_TTL:
+        entry['version'] = es.get('')['version']['number']
+        entry['version_checked'] = now
+
+    return es, entry['version']
+
 
-    return es, version
+def es_reset():
+    """Drop every pooled client, forcing new connections and version probes.
+    """
+    with ES_CLIENTS_LOCK:
+        ES_CLIENTS.clear()
 
 
 def es_mapping(version):
@@ -538,27 +1057,196 @@ def parse_url(url):
     return catalog_slug
 
 
+def bulk_action(op_type, catalog, doc_id=None):
+    action = {op_type: {'_index': catalog, '_type': 'layer'}}
+    if doc_id is not None:
+        action[op_type]['_id'] = doc_id
+
+    return action
+
+
+def bulk_index(es, actions):
+    """Send (action, document) pairs through the _bulk api.
+       Returns the list of (action, document, error) that were rejected.
+    """
+    lines = []
+    for action, doc in actions:
+        lines.append(json.dumps(action))
+        if doc is not None:
+            lines.append(json.dumps(doc))
+    bulk_body = '\n'.join(lines) + '\n'
+
+    try:
+        response = es.post('_bulk', data=bulk_body)
+    except (ElasticException, requests.exceptions.RequestException) as e:
+        return [(action, doc, str(e)) for action, doc in actions]
+
+    failed = []
+    if response.get('errors'):
+        for (action, doc), item in zip(actions, response['items']):
+            result = list(item.values())[0]
+            if result.get('status', 500) >= 300 and 'error' in result:
+                failed.append((action, doc, result['error']))
+
+    return failed
+
+
+class IndexQueue(object):
+    """Accumulates layer documents and sends them to elasticsearch in batches.
+
+       Documents are flushed when batch_size is reached, after flush_interval
+       seconds, on flush() and at interpreter exit. Producers that fill the
+       queue flush it themselves, and at most max_inflight bulk requests are
+       sent at the same time, so fast harvests are slowed down to the
+       indexing rate instead of growing the queue without bound.
+       Rejected documents are kept in failed and can be sent again with
+       retry_failed().
+    """
+    def __init__(self, batch_size=REGISTRY_INDEX_BATCH_SIZE,
+                 flush_interval=REGISTRY_INDEX_FLUSH_INTERVAL,
+                 max_inflight=REGISTRY_INDEX_MAX_INFLIGHT,
+                 max_failed=REGISTRY_INDEX_MAX_FAILED):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.failed = collections.deque(maxlen=max_failed)
+        self.indexed = 0
+        self.lock = threading.Lock()
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+        self.thread = None
+
+    def put(self, catalog, doc, doc_id=None):
+        self.add(bulk_action('index', catalog, doc_id), doc)
+
+    def delete(self, catalog, doc_id):
+        self.add(bulk_action('delete', catalog, doc_id), None)
+
+    def add(self, action, doc):
+        with self.lock:
+            self.pending.append((action, doc))
+            full = len(self.pending) >= self.batch_size
+            self.start()
+
+        if full:
+            self.flush()
+
+    def start(self):
+        if self.thread is None and self.flush_interval > 0:
+            self.thread = threading.Thread(target=self.run, name='registry-index-queue')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                LOGGER.error('Index queue flush failed: {0}'.format(e))
+
+    def flush(self):
+        while True:
+            with self.lock:
+                batch = self.pending[:self.batch_size]
+                self.pending = self.pending[self.batch_size:]
+            if not batch:
+                return
+            self.send(batch)
+
+    def send(self, batch):
+        with self.inflight:
+            es = es_client(REGISTRY_SEARCH_URL)['es']
+            failed = bulk_index(es, batch)
+
+        with self.lock:
+            self.indexed += len(batch) - len(failed)
+            for action, doc, error in failed:
+                self.failed.append((action, doc, error))
+
+        for catalog in set(list(action.values())[0]['_index'] for action, _ in batch):
+            invalidate_search_cache(catalog)
+
+        if failed:
+            LOGGER.error('{0} of {1} documents were not indexed. First error: {2}'.format(
+                len(failed), len(batch), failed[0][2]))
+        else:
+            LOGGER.debug('{0} documents indexed'.format(len(batch)))
+
+        return failed
+
+    def retry_failed(self):
+        with self.lock:
+            retries = [(action, doc) for action, doc, _ in self.failed]
+            self.failed.clear()
+            self.pending.extend(retries)
+        self.flush()
+
+
+INDEX_QUEUE = IndexQueue()
+atexit.register(INDEX_QUEUE.flush)
+
+
+def database_engine(database):
+    """Register the engine pycsw uses for database, with a sized connection pool.
+       pycsw memoizes engines by url, sqlite keeps the pycsw engine and its functions.
+    """
+    if database not in Repository._engines and not database.startswith('sqlite'):
+        Repository._engines[database] = create_engine(database,
+                                                      pool_size=REGISTRY_DATABASE_POOL_SIZE,
+                                                      max_overflow=REGISTRY_DATABASE_MAX_OVERFLOW,
+                                                      pool_recycle=REGISTRY_DATABASE_POOL_RECYCLE)
+
+    return Repository._engines.get(database)
+
+
 class RegistryRepository(Repository):
     def __init__(self, *args, **kwargs):
         self.catalog = None
         if args and hasattr(args[0], 'url'):
             url = args[0].url
             self.catalog = parse_url(url) if urlparse(url).path != '/csw' else None
-        try:
-            self.es, self.version = es_connect(url=REGISTRY_SEARCH_URL)
-            self.es_status = 200
-        except requests.exceptions.ConnectionError:
-            self.es_status = 404
+
+        # Elasticsearch is only reached when a transaction needs it.
+        self._es, self._es_status, self.version = None, None, None
 
         database = PYCSW['repository']['database']
+        database_engine(database)
 
         return super(RegistryRepository, self).__init__(database, context=config.StaticContext())
 
+    def connect_es(self):
+        if self._es_status is None:
+            try:
+                self._es, self.version = es_connect(url=REGISTRY_SEARCH_URL)
+                self._es_status = 200
+            except requests.exceptions.ConnectionError:
+                self._es_status = 404
+
+    @property
+    def es(self):
+        self.connect_es()
+        return self._es
+
+    @property
+    def es_status(self):
+        self.connect_es()
+        return self._es_status
+
+    def get_record_by_id(self, identifier):
+        """Return the record with the given identifier, or None.
+        """
+        column = getattr(self.dataset, self.context.md_core_model['mappings']['pycsw:Identifier'])
+        # Do not return records cached by the session from a previous request.
+        self.session.expunge_all()
+
+        return self._get_repo_filter(self.session.query(self.dataset)).filter(column == identifier).first()
+
     def insert(self, *args, **kwargs):
         record = args[0]
         LOGGER.debug('inserting record {0}'.format(record))
         record.xml = record.xml.decode('utf-8')
         super(RegistryRepository, self).insert(*args)
+        invalidate_layer(record.identifier)
         if self.es_status != 200:
             return
         if not check_index_exists(self.catalog):
@@ -570,28 +1258,72 @@ class RegistryRepository(Repository):
 
         es_dict = record_to_dict(record)
         # TODO: Do not index wrong bounding boxes.
-        try:
-            self.es[self.catalog]['layer'].post(data=es_dict)
-            LOGGER.debug("Record {0} indexed".format(es_dict['title']))
-        except ElasticException as e:
-            LOGGER.error(e)
-
+        INDEX_QUEUE.put(self.catalog, es_dict, doc_id=record.identifier)
+        LOGGER.debug("Record {0} queued for indexing".format(es_dict['title']))
 
     def delete(self, *args, **kwargs):
-        # Get layer uuid from pycsw.
-        uuid = args[0]['values'][0]
+        # Get layer uuids from pycsw before they are removed.
+        uuids = self.constraint_identifiers(args[0])
 
         # Remove layer executing pycsw repository delete function.
         count = super(RegistryRepository, self).delete(*args)
+        for uuid in uuids:
+            invalidate_layer(uuid)
         if self.es_status != 200:
             return count
 
-        # Return layer id and catalog from elasticsearch.
-        _ , layer_id, layer_index = get_data_from_es(self.es, uuid)
-        self.es.delete('%s/layer/%s' % (layer_index, layer_id))
+        # Documents are indexed using the layer uuid as id.
+        catalogs = [self.catalog] if self.catalog else list_catalogs(self.es)
+        for catalog in catalogs:
+            for uuid in uuids:
+                INDEX_QUEUE.delete(catalog, uuid)
+
+        return count
+
+    def update(self, record=None, recprops=None, constraint=None):
+        count = super(RegistryRepository, self).update(record=record, recprops=recprops, constraint=constraint)
+        if record is not None:
+            invalidate_layer(record.identifier)
+        elif constraint is not None:
+            for uuid in self.constraint_identifiers(constraint):
+                invalidate_layer(uuid)
 
         return count
 
+    def iter_records(self, after=None, page_size=REGISTRY_CSW_MAX_RECORDS):
+        """Yield pages of records ordered by identifier, starting after the given one.
+           Pages are read with keyset pagination so every page costs the same.
+        """
+        identifier_name = self.context.md_core_model['mappings']['pycsw:Identifier']
+        identifier = getattr(self.dataset, identifier_name)
+        while True:
+            query = self._get_repo_filter(self.session.query(self.dataset))
+            if after is not None:
+                query = query.filter(identifier > after)
+            page = query.order_by(identifier).limit(page_size).all()
+            if not page:
+                return
+            yield page
+            after = getattr(page[-1], identifier_name)
+
+    def constraint_identifiers(self, constraint):
+        """Return the identifiers of the records, and their children, matched by a CSW-T constraint.
+        """
+        mappings = self.context.md_core_model['mappings']
+        identifier = getattr(self.dataset, mappings['pycsw:Identifier'])
+        parent_identifier = getattr(self.dataset, mappings['pycsw:ParentIdentifier'])
+
+        rows = self._get_repo_filter(self.session.query(identifier)).filter(
+            text(constraint['where'])).params(self._create_values(constraint['values']))
+        uuids = [row[0] for row in rows]
+
+        if uuids:
+            children = self._get_repo_filter(self.session.query(identifier)).filter(
+                parent_identifier.in_(uuids))
+            uuids.extend(row[0] for row in children)
+
+        return uuids
+
 
 def parse_get_params(request):
     """
@@ -784,6 +1516,33 @@ def parse_ISO8601(time_gap):
     return quantity, units.get(unit)
 
 
+# Field profiles of d_docs_fields, as (includes, excludes) of the hits _source.
+SEARCH_FIELD_PROFILES = {
+    'full': None,
+    'lean': ([], ['checks_list', 'registry', 'references', 'layer_geoshape']),
+    'summary': (['layer_identifier', 'title', 'abstract', 'layer_date', 'layer_originator', 'source',
+                 'source_type', 'tile_url', 'links', 'min_x', 'min_y', 'max_x', 'max_y', 'reliability_rate'], []),
+    'minimal': (['layer_identifier', 'title', 'layer_date', 'bbox'], []),
+}
+REGISTRY_SEARCH_FIELDS = os.getenv('REGISTRY_SEARCH_FIELDS', 'full')
+
+
+def parse_source_fields(value):
+    """Return the (includes, excludes) of a field profile or a list of fields
+       separated by ',' where fields starting with '-' are excluded.
+    """
+    if value in SEARCH_FIELD_PROFILES:
+        return SEARCH_FIELD_PROFILES[value]
+
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if not fields:
+        raise ValueError('No fields given')
+    includes = [field for field in fields if not field.startswith('-')]
+    excludes = [field[1:] for field in fields if field.startswith('-')]
+
+    return includes, excludes
+
+
 class SearchSerializer(serializers.Serializer):
     q_time = serializers.CharField(
         required=False,
@@ -844,6 +1603,18 @@ class SearchSerializer(serializers.Serializer):
         help_text="When documents to return are more than d_docs_limit they can be paginated by this value.",
         default=1
     )
+    d_docs_cursor = serializers.CharField(
+        required=False,
+        help_text="Pages documents with a cursor instead of d_docs_page. Use '*' for the first page and the "
+                  "d.docs.cursor value of the response for the next one. The cursor is null on the last page."
+    )
+    d_docs_fields = serializers.CharField(
+        required=False,
+        help_text="Fields of the documents to return. Either a profile: {0}, or a list of fields separated by "
+                  "',' where fields starting with '-' are left out. Example: title,abstract,-abstract.*".format(
+                      ", ".join(sorted(SEARCH_FIELD_PROFILES))),
+        default=REGISTRY_SEARCH_FIELDS
+    )
     d_docs_sort = serializers.ChoiceField(
         required=False,
         help_text="How to order the documents before returning the top X. 'score' is keyword search relevancy. "
@@ -943,6 +1714,47 @@ class SearchSerializer(serializers.Serializer):
             raise serializers.ValidationError("d_docs_page cant be zero or negative")
         return value
 
+    def validate_d_docs_cursor(self, value):
+        """
+        Would be '*' for the first page or a cursor returned by a previous search.
+        Returns the decoded cursor.
+        """
+        if value == '*':
+            return {}
+        try:
+            return decode_cursor(value)
+        except Exception:
+            raise serializers.ValidationError("d_docs_cursor is not a valid cursor")
+
+    def validate_d_docs_fields(self, value):
+        """
+        Would be a profile name or a list of fields.
+        Returns the (includes, excludes) of the _source, or None for the full documents.
+        """
+        try:
+            return parse_source_fields(value)
+        except ValueError as e:
+            raise serializers.ValidationError(e)
+
+    def validate(self, data):
+        if data.get('d_docs_cursor') is not None and data.get('d_docs_page', 1) != 1:
+            raise serializers.ValidationError("d_docs_page can not be used with d_docs_cursor")
+        return data
+
+
+def encode_cursor(cursor):
+    """Return the opaque token of a cursor: {'after': sort values} or {'scroll': scroll id}.
+    """
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    cursor = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    if not isinstance(cursor, dict) or not (isinstance(cursor.get('after'), list) or cursor.get('scroll')):
+        raise ValueError('Invalid cursor {0}'.format(token))
+
+    return cursor
+
 
 def create_nested_json(json_path, json_query, json_field):
     return {
@@ -958,16 +1770,19 @@ def create_nested_json(json_path, json_query, json_field):
     }
 
 
-def elasticsearch(serializer, catalog):
-    """
-    https://www.elastic.co/guide/en/elasticsearch/reference/current/_the_search_api.html
-    :param serializer:
-    :return:
+class SearchError(Exception):
+    """A search that can not be sent to Elasticsearch, with the status and error of its response.
     """
-    # Make sure elasticsearch connection is available.
-    es, version = es_connect(url=REGISTRY_SEARCH_URL)
-    es_version = int(version[0])
+    def __init__(self, status, error):
+        super(SearchError, self).__init__(status, error)
+        self.status = status
+        self.error = error
 
+
+def compile_search(serializer, catalog, es, es_version, check_catalog=True):
+    """Return the endpoint and body of the Elasticsearch query of a validated search.
+       Raises SearchError when the search is not valid for the catalog.
+    """
     search_engine_endpoint = "_search"
     if catalog:
         search_engine_endpoint = "{0}/_search".format(catalog)
@@ -975,6 +1790,8 @@ def elasticsearch(serializer, catalog):
     search_endpoint = serializer.validated_data.get("search_engine_endpoint")
     if search_endpoint is not None:
         search_engine_endpoint = "{0}/{1}".format(search_endpoint, search_engine_endpoint)
+    elif catalog and check_catalog and not check_index_exists(catalog, es):
+        raise SearchError(404, {"error": {"msg": "Catalog {0} does not exist".format(catalog)}})
 
     q_text = serializer.validated_data.get("q_text")
     q_registry_text = serializer.validated_data.get("q_registry_text")
@@ -988,13 +1805,14 @@ def elasticsearch(serializer, catalog):
     d_docs_sort = serializer.validated_data.get("d_docs_sort")
     d_docs_limit = int(serializer.validated_data.get("d_docs_limit"))
     d_docs_page = int(serializer.validated_data.get("d_docs_page"))
+    d_docs_cursor = serializer.validated_data.get("d_docs_cursor")
+    d_docs_fields = serializer.validated_data.get("d_docs_fields")
     a_time_gap = serializer.validated_data.get("a_time_gap")
     a_time_limit = serializer.validated_data.get("a_time_limit")
     a_categories_limit = serializer.validated_data.get("a_categories_limit")
     a_hm_gridlevel = serializer.validated_data.get("a_hm_gridlevel")
     a_hm_limit = serializer.validated_data.get("a_hm_limit")
     a_hm_filter = serializer.validated_data.get("a_hm_filter")
-    original_response = serializer.validated_data.get("original_response")
 
     # Dict for search on Elastic engine
     must_array = []
@@ -1129,16 +1947,29 @@ def elasticsearch(serializer, catalog):
     if d_docs_sort == "time":
         dic_query["sort"] = {"layer_date": {"order": "desc"}}
 
+    if d_docs_fields:
+        includes, excludes = d_docs_fields
+        dic_query["_source"] = {"includes": includes, "excludes": excludes}
+
+    if d_docs_cursor is not None:
+        # Cursor pages never use from, and layer_identifier breaks sort ties so
+        # every document has a unique position to resume after.
+        dic_query.pop("from", None)
+        sort = dic_query.get("sort")
+        dic_query["sort"] = ([sort] if sort else []) + [{"layer_identifier": {"order": "asc"}}]
+        if "after" in d_docs_cursor:
+            dic_query["search_after"] = d_docs_cursor["after"]
+
     if a_time_limit:
         # TODO: Work in progress, a_time_limit is incomplete.
         # TODO: when times are * it does not work. also a a_time_gap is not required.
         if q_time:
             if not a_time_gap:
                 msg = "If you want to use a_time_limit feature, a_time_gap MUST BE initialized"
-                return 400, {"error": {"msg": msg}}
+                raise SearchError(400, {"error": {"msg": msg}})
         else:
             msg = "If you want to use a_time_limit feature, q_time MUST BE initialized"
-            return 400, {"error": {"msg": msg}}
+            raise SearchError(400, {"error": {"msg": msg}})
 
     if a_time_gap:
         interval = gap_to_elastic(a_time_gap)
@@ -1176,6 +2007,14 @@ def elasticsearch(serializer, catalog):
             Ymax, Xmax = a_hm_filter.split(" TO ")[1].split(",")
             heatmap_filter_box = [[Xmin, Ymax], [Xmax, Ymin]]
 
+        if a_hm_gridlevel:
+            # Close viewports snap to the same cells, so their heatmap tiles can be reused.
+            min_x, min_y, max_x, max_y = snap_heatmap_box(
+                (float(heatmap_filter_box[0][0]), float(heatmap_filter_box[1][1]),
+                 float(heatmap_filter_box[1][0]), float(heatmap_filter_box[0][1])), int(a_hm_gridlevel))
+            heatmap_filter_box = [[min_x, max_y], [max_x, min_y]]
+
+        # Layers are counted in the cells they intersect, as heatmap tiles count them.
         heatmap = {
             "heatmap": {
                 "field": "layer_geoshape",
@@ -1187,7 +2026,7 @@ def elasticsearch(serializer, catalog):
                                 "type": "envelope",
                                 "coordinates": heatmap_filter_box
                             },
-                            "relation": "within"
+                            "relation": "intersects"
                         }
                     }
                 }
@@ -1204,11 +2043,75 @@ def elasticsearch(serializer, catalog):
     # adding aggreations on body query
     if aggs_dic:
         dic_query['aggs'] = aggs_dic
+
+    return search_engine_endpoint, dic_query
+
+
+def elasticsearch(serializer, catalog):
+    """
+    https://www.elastic.co/guide/en/elasticsearch/reference/current/_the_search_api.html
+    :param serializer:
+    :return:
+    """
+    # Make sure elasticsearch connection is available.
+    es, version = es_connect(url=REGISTRY_SEARCH_URL)
+    es_version = int(version[0])
+
+    try:
+        search_engine_endpoint, dic_query = compile_search(serializer, catalog, es, es_version)
+    except SearchError as e:
+        return e.status, e.error
+
+    d_docs_cursor = serializer.validated_data.get("d_docs_cursor")
+    heatmap = facets = None
+    if d_docs_cursor is None and not serializer.validated_data.get("original_response"):
+        heatmap = tiled_heatmap(es, search_engine_endpoint, dic_query, catalog)
+        facets = rollup_facets(es, serializer, catalog, dic_query)
+
+    endpoint, body, params = search_request(serializer, search_engine_endpoint, dic_query, es_version)
+    kwargs = {"params": params} if params else {}
+    if d_docs_cursor is None and serializer.validated_data.get("original_response"):
+        # The original response is sent as received, without decoding it.
+        kwargs["json_decoder"] = RawJSON
     try:
-        es_response = es.post(search_engine_endpoint, data=dic_query)
+        es_response = es.post(endpoint, data=body, **kwargs)
     except ElasticException as e:
         return e.status_code, {"error": {"msg": str(e.args)}}
-    if original_response:
+    if heatmap is not None:
+        es_response.setdefault('aggregations', {})['viewport'] = heatmap
+    if facets is not None:
+        es_response.setdefault('aggregations', {}).update(facets)
+
+    return shape_search(serializer, search_engine_endpoint, dic_query, es_response)
+
+
+def search_request(serializer, search_engine_endpoint, dic_query, es_version):
+    """Return the (endpoint, body, url parameters) of the Elasticsearch request of a compiled search.
+    """
+    d_docs_cursor = serializer.validated_data.get("d_docs_cursor")
+    # search_after is not available before Elasticsearch 5, cursors use a scroll instead.
+    if d_docs_cursor is None or es_version >= 5:
+        return search_engine_endpoint, dic_query, {}
+
+    if "scroll" not in d_docs_cursor:
+        return search_engine_endpoint, dic_query, {"scroll": REGISTRY_SEARCH_SCROLL}
+
+    # The scroll endpoint is not under the index.
+    scroll_endpoint = "_search/scroll"
+    search_endpoint = serializer.validated_data.get("search_engine_endpoint")
+    if search_endpoint is not None:
+        scroll_endpoint = "{0}/{1}".format(search_endpoint, scroll_endpoint)
+
+    return scroll_endpoint, {"scroll": REGISTRY_SEARCH_SCROLL, "scroll_id": d_docs_cursor["scroll"]}, {}
+
+
+def shape_search(serializer, search_engine_endpoint, dic_query, es_response):
+    """Return the registry response of an Elasticsearch search response.
+    """
+    d_docs_limit = int(serializer.validated_data.get("d_docs_limit"))
+    d_docs_cursor = serializer.validated_data.get("d_docs_cursor")
+    a_time_gap = serializer.validated_data.get("a_time_gap")
+    if serializer.validated_data.get("original_response"):
         return es_response
 
     data = {}
@@ -1266,88 +2169,679 @@ def elasticsearch(serializer, catalog):
     if not int(d_docs_limit) == 0:
         for item in es_response['hits']['hits']:
             # data
-            temp = item['_source']['abstract']
+            temp = item['_source'].get('abstract')
             if temp:
                 item['_source']['abstract'] = temp.encode('ascii', 'ignore').decode('utf-8')
             docs.append(item['_source'])
 
     data["d.docs"] = docs
-    return data
 
+    if d_docs_cursor is not None:
+        hits = es_response['hits']['hits']
+        data["d.docs.cursor"] = None
+        if d_docs_limit and len(hits) == d_docs_limit:
+            if "_scroll_id" in es_response:
+                data["d.docs.cursor"] = encode_cursor({"scroll": es_response["_scroll_id"]})
+            else:
+                data["d.docs.cursor"] = encode_cursor({"after": hits[-1]["sort"]})
 
-def search_view(request, catalog=None):
-    request.GET = parse_get_params(request)
-    serializer = SearchSerializer(data=request.GET)
-    try:
-        serializer.is_valid(raise_exception=True)
-        data = elasticsearch(serializer, catalog)
-        data = json.dumps(data)
-        status = 200
-    except serializers.ValidationError as error:
-        data = error
-        status = 400
+    return data
 
-    return HttpResponse(data, status=status, content_type='application/json')
 
+# Cells of heatmap tiles: (catalog, endpoint, query hash, generation, grid level, tile) -> {(column, row): count}
+HEATMAP_TILES = LRUCache(maxsize=REGISTRY_HEATMAP_CACHE_SIZE, ttl=REGISTRY_HEATMAP_CACHE_TTL)
 
-def configure_mapproxy(extra_config, seed=False, ignore_warnings=True, renderd=False):
-    """Create an validate mapproxy configuration based on a dict.
+
+def heatmap_cell_size(grid_level):
+    """Return the width and height in degrees of the quadtree cells of grid_level.
     """
-    # Start with a sane configuration using MapProxy's defaults
-    conf_options = load_default_config()
+    return 360.0 / 2 ** grid_level, 180.0 / 2 ** grid_level
 
-    # Merge both
-    load_config(conf_options, config_dict=extra_config)
 
-    # Make sure the config is valid.
-    errors, informal_only = validate_options(conf_options)
-    for error in errors:
-        LOGGER.warn(error)
-    if errors and not ignore_warnings:
-        raise ConfigurationError('invalid configuration: %s' % ', '.join(errors))
+def heatmap_cells(box, grid_level):
+    """Return the (first column, first row, last column, last row) of the cells of grid_level
+       covering box, counted from the south west corner of the world, last ones excluded.
+    """
+    width, height = heatmap_cell_size(grid_level)
+    size = 2 ** grid_level
+    min_x, min_y, max_x, max_y = box
+    # Boxes already on the cell boundaries must not grow by rounding errors.
+    epsilon = 1e-9
+    first_column = min(size - 1, max(0, int(math.floor((min_x + 180) / width + epsilon))))
+    first_row = min(size - 1, max(0, int(math.floor((min_y + 90) / height + epsilon))))
+    last_column = min(size, max(first_column + 1, int(math.ceil((max_x + 180) / width - epsilon))))
+    last_row = min(size, max(first_row + 1, int(math.ceil((max_y + 90) / height - epsilon))))
 
-    errors = validate_references(conf_options)
-    for error in errors:
-        LOGGER.warn(error)
-    if errors and not ignore_warnings:
-        raise ConfigurationError('invalid references: %s' % ', '.join(errors))
+    return first_column, first_row, last_column, last_row
 
-    conf = ProxyConfiguration(conf_options, seed=seed, renderd=renderd)
 
-    return conf
+def snap_heatmap_box(box, grid_level):
+    """Return the (min_x, min_y, max_x, max_y) of box grown to the cell boundaries of grid_level.
+    """
+    width, height = heatmap_cell_size(grid_level)
+    first_column, first_row, last_column, last_row = heatmap_cells(box, grid_level)
 
+    return (first_column * width - 180, first_row * height - 90, last_column * width - 180, last_row * height - 90)
 
-LAYER_SRS_FOR_TYPE = {
-    'Hypermap:WARPER': 'EPSG:90013',
-    'ESRI:ArcGIS:MapServer': 'EPSG:3857',
-    'ESRI:ArcGIS:ImageServer': 'EPSG:3857',
-    'OGC:WMS': 'EPSG:4326'
-}
 
-GRID_SRS_FOR_TYPE = {
-    'Hypermap:WARPER': 'EPSG:90013',
-    'ESRI:ArcGIS:MapServer': 'EPSG:3857',
-    'ESRI:ArcGIS:ImageServer': 'EPSG:3857',
-    'OGC:WMS': 'EPSG:3857'
-}
+def heatmap_tile_cells(grid_level):
+    return min(REGISTRY_HEATMAP_TILE_CELLS, 2 ** grid_level)
 
 
-class RegistryMapProxyApp(MapProxyApp):
-    def welcome_response(self, script_url):
-        html = "<html><body><h1>Registry MapProxy</h1>"
-        html += "<h4>Version: %s</h4>" % version
-        if 'demo' in self.handlers:
-            html += ('<p>You can find services and sample openlayers configuration at:'
-                     '<a href="%s/demo/">demo</a>') % (script_url, )
-        return Response(html, mimetype='text/html')
-        pass
+def heatmap_tile_query(query, heatmap, grid_level, tile):
+    """Return the body of the search computing the heatmap of one tile. Layers crossing
+       the tile border are counted in the cells of the tile they intersect, with the same
+       relation as the heatmap of compile_search.
+    """
+    width, height = heatmap_cell_size(grid_level)
+    cells = heatmap_tile_cells(grid_level)
+    min_x, min_y = tile[0] * cells * width - 180, tile[1] * cells * height - 90
+    max_x, max_y = min_x + cells * width, min_y + cells * height
+    tile_heatmap = dict(heatmap, grid_level=grid_level, max_cells=(cells + 2) ** 2)
+    tile_heatmap['geom'] = {
+        "geo_shape": {
+            "layer_geoshape": {
+                "shape": {"type": "envelope", "coordinates": [[min_x, max_y], [max_x, min_y]]},
+                "relation": "intersects"
+            }
+        }
+    }
 
+    return {"size": 0, "query": query, "aggs": {"viewport": {"heatmap": tile_heatmap}}}
 
-def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_as_yaml=True):
-    """Creates a mapproxy config for a given layer-like object.
-       Compatible with django-registry and GeoNode.
+
+def heatmap_response_cells(viewport, grid_level):
+    """Return the non zero counts of a heatmap aggregation as {(column, row): count}.
     """
-    bbox = list(wkt2geom(layer.wkt_geometry))
+    width, height = heatmap_cell_size(grid_level)
+    first_column = int(round((viewport['min_x'] + 180) / width))
+    top_row = int(round((viewport['max_y'] + 90) / height)) - 1
+    cells = {}
+    # Rows are listed from north to south, and are null when all their counts are 0.
+    for row, counts in enumerate(viewport.get('counts') or []):
+        for column, count in enumerate(counts or []):
+            if count:
+                cells[(first_column + column, top_row - row)] = count
+
+    return cells
+
+
+def stitch_heatmap(cells, cell_range, grid_level):
+    """Return the heatmap aggregation of the cells in cell_range, as Elasticsearch returns it.
+    """
+    width, height = heatmap_cell_size(grid_level)
+    first_column, first_row, last_column, last_row = cell_range
+    counts = []
+    for row in range(last_row - 1, first_row - 1, -1):
+        counts.append([cells.get((column, row), 0) for column in range(first_column, last_column)])
+        if not any(counts[-1]):
+            counts[-1] = None
+
+    return {
+        'grid_level': grid_level,
+        'columns': last_column - first_column,
+        'rows': last_row - first_row,
+        'min_x': first_column * width - 180,
+        'max_x': last_column * width - 180,
+        'min_y': first_row * height - 90,
+        'max_y': last_row * height - 90,
+        'counts': counts if any(counts) else None,
+    }
+
+
+def tiled_heatmap(es, search_engine_endpoint, dic_query, catalog):
+    """Return the heatmap aggregation of a search stitched from cached tiles, computing the
+       missing ones with a single _msearch. The heatmap is then removed from dic_query.
+       Returns None when the heatmap has no explicit grid level or covers too many tiles.
+    """
+    heatmap = dic_query.get('aggs', {}).get('viewport', {}).get('heatmap')
+    if not REGISTRY_HEATMAP_CACHE_SIZE or not heatmap or heatmap.get('grid_level') is None:
+        return None
+
+    grid_level = heatmap['grid_level']
+    (min_x, max_y), (max_x, min_y) = heatmap['geom']['geo_shape']['layer_geoshape']['shape']['coordinates']
+    cell_range = heatmap_cells((float(min_x), float(min_y), float(max_x), float(max_y)), grid_level)
+    tile_cells = heatmap_tile_cells(grid_level)
+    tiles = [(column, row)
+             for column in range(cell_range[0] // tile_cells, (cell_range[2] - 1) // tile_cells + 1)
+             for row in range(cell_range[1] // tile_cells, (cell_range[3] - 1) // tile_cells + 1)]
+    if len(tiles) > REGISTRY_HEATMAP_MAX_TILES:
+        return None
+
+    query_hash = hashlib.sha1(json.dumps(dic_query['query'], sort_keys=True).encode('utf-8')).hexdigest()
+    generation = search_generation(catalog or '*')
+    keys = [(catalog or '*', search_engine_endpoint, query_hash, generation, grid_level, tile) for tile in tiles]
+    cells = {}
+    missing = []
+    for key in keys:
+        cached = HEATMAP_TILES.get(key)
+        if cached is None:
+            missing.append(key)
+        else:
+            cells.update(cached)
+
+    if missing:
+        lines = []
+        for key in missing:
+            lines.extend(['{}', json.dumps(heatmap_tile_query(dic_query['query'], heatmap, grid_level, key[-1]))])
+        msearch_endpoint = search_engine_endpoint[:-len('_search')] + '_msearch'
+        try:
+            responses = es.post(msearch_endpoint, data='\n'.join(lines) + '\n')['responses']
+        except ElasticException as e:
+            LOGGER.warn('Heatmap tiles were not computed: {0}'.format(e))
+            return None
+        if any('error' in response for response in responses):
+            # Errors are left to the search without tiles, which reports them.
+            return None
+        for key, response in zip(missing, responses):
+            # Cells outside the tile belong to the neighbour tiles.
+            tile = key[-1]
+            tile_range = (tile[0] * tile_cells, tile[1] * tile_cells,
+                          (tile[0] + 1) * tile_cells, (tile[1] + 1) * tile_cells)
+            tile_counts = dict((cell, count) for cell, count in
+                               heatmap_response_cells(response['aggregations']['viewport'], grid_level).items()
+                               if tile_range[0] <= cell[0] < tile_range[2] and tile_range[1] <= cell[1] < tile_range[3])
+            HEATMAP_TILES.set(key, tile_counts)
+            cells.update(tile_counts)
+
+    del dic_query['aggs']['viewport']
+    if not dic_query['aggs']:
+        del dic_query['aggs']
+
+    return stitch_heatmap(cells, cell_range, grid_level)
+
+
+# Rollups of daily document and category counts per catalog ('*' for all of them).
+ROLLUPS = {}
+ROLLUPS_LOCK = threading.Lock()
+ROLLUPS_BUILDING = set()
+ROLLUP_FILTERS = ['q_text', 'q_registry_text', 'q_references_url', 'q_references_scheme', 'q_uuid', 'q_user',
+                  'search_engine_endpoint', 'd_docs_cursor']
+WORLD_GEO = '[-90.0,-180.0 TO 90.0,180.0]'
+EPOCH_DATE = datetime.date(1970, 1, 1)
+
+
+def build_rollup(es, catalog):
+    """Return the document and category counts per day of a catalog, computed with one aggregation.
+    """
+    categories = {
+        "nested": {"path": "registry"},
+        "aggs": {"categories": {"terms": {"field": "registry.category", "size": REGISTRY_ROLLUP_MAX_CATEGORIES}}}
+    }
+    query = {
+        "size": 0,
+        "aggs": {
+            "days": {
+                "date_histogram": {"field": "layer_date", "interval": "day", "min_doc_count": 1},
+                "aggs": {"registry": categories}
+            },
+            "registry": categories
+        }
+    }
+    response = es.post('{0}/_search'.format(catalog) if catalog else '_search', data=query)
+    aggs = response['aggregations']
+
+    rollup = {
+        'categories': dict((item['key'], item['doc_count']) for item in aggs['registry']['categories']['buckets']),
+        'days': {},
+        'day_categories': {},
+    }
+    for bucket in aggs['days']['buckets']:
+        day = int(bucket['key'] // 86400000)
+        rollup['days'][day] = bucket['doc_count']
+        rollup['day_categories'][day] = dict(
+            (item['key'], item['doc_count']) for item in bucket['registry']['categories']['buckets'])
+    try:
+        for day in rollup['days']:
+            EPOCH_DATE + datetime.timedelta(days=day)
+    except OverflowError:
+        # Dates out of the python calendar, the histogram is left to Elasticsearch.
+        rollup['days'] = None
+
+    return rollup
+
+
+def refresh_rollup(es, catalog, generation):
+    key = catalog or '*'
+    try:
+        rollup = build_rollup(es, catalog)
+        rollup['generation'] = generation
+        rollup['built'] = time.time()
+        ROLLUPS[key] = rollup
+    finally:
+        with ROLLUPS_LOCK:
+            ROLLUPS_BUILDING.discard(key)
+
+    return rollup
+
+
+def get_rollup(es, catalog):
+    """Return the rollup of a catalog. The first one is built by the search, later ones
+       are rebuilt in a background thread after writes or when they expire, once at a
+       time per catalog, while searches keep using the previous rollup.
+    """
+    key = catalog or '*'
+    generation = search_generation(key)
+    rollup = ROLLUPS.get(key)
+    if rollup is not None:
+        age = time.time() - rollup['built']
+        stale = rollup['generation'] != generation and age >= REGISTRY_ROLLUP_REBUILD_INTERVAL
+        if not stale and age <= REGISTRY_ROLLUP_TTL:
+            return rollup
+
+    with ROLLUPS_LOCK:
+        building = key in ROLLUPS_BUILDING
+        ROLLUPS_BUILDING.add(key)
+    if rollup is None and not building:
+        return refresh_rollup(es, catalog, generation)
+    if rollup is None:
+        raise ValueError('Rollup of {0} is being built'.format(key))
+
+    if not building:
+        def refresh():
+            try:
+                refresh_rollup(es, catalog, generation)
+            except Exception as e:
+                LOGGER.error('Rollup of {0} was not rebuilt: {1}'.format(key, e))
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    return rollup
+
+
+def rollup_bucket(day, interval):
+    """Return the first day of the date_histogram bucket of interval holding day,
+       or None when the buckets of interval are not made of whole days.
+    """
+    matcher = re.match(r'^(\d+)([ywdh])$', interval)
+    if not matcher:
+        return None
+    quantity, unit = int(matcher.group(1)), matcher.group(2)
+    date = EPOCH_DATE + datetime.timedelta(days=day)
+    if unit == 'y' and quantity == 1:
+        return (datetime.date(date.year, 1, 1) - EPOCH_DATE).days
+    if unit == 'w' and quantity == 1:
+        return day - date.weekday()
+    if unit == 'h' and quantity % 24 == 0:
+        unit, quantity = 'd', quantity // 24
+    if unit == 'd' and quantity > 0:
+        # Fixed intervals are aligned to the epoch.
+        return day // quantity * quantity
+
+    return None
+
+
+def rollup_first_day(q_time):
+    """Return the first day of a q_time range, None when it is open.
+       Raises ValueError when the range can not be answered with whole days.
+    """
+    if not q_time:
+        return None
+    start, end = str(q_time)[1:-1].split(" TO ")
+    if end != '*' or (start != '*' and not start.endswith('T00:00:00Z')):
+        raise ValueError('Range {0} is not made of whole days'.format(q_time))
+    if start == '*':
+        return None
+
+    return (datetime.datetime.strptime(start, '%Y-%m-%dT00:00:00Z').date() - EPOCH_DATE).days
+
+
+def rollup_facets(es, serializer, catalog, dic_query):
+    """Answer the time histogram and categories facets of a search from the catalog rollup and
+       remove their aggregations from dic_query. Returns the aggregations answered, or None.
+    """
+    aggs = dic_query.get('aggs', {})
+    if not REGISTRY_ROLLUPS or not ('articles_over_time' in aggs or 'registry_categories' in aggs):
+        return None
+    params = serializer.validated_data
+    if any(params.get(param) is not None for param in ROLLUP_FILTERS) or params.get('q_geo') not in (None, WORLD_GEO):
+        return None
+    try:
+        first_day = rollup_first_day(params.get('q_time'))
+        rollup = get_rollup(es, catalog)
+    except (ValueError, ElasticException) as e:
+        LOGGER.debug('Facets not answered from rollups: {0}'.format(e))
+        return None
+
+    answered = {}
+    days = rollup['days']
+    if days is not None:
+        days = dict((day, count) for day, count in days.items() if first_day is None or day >= first_day)
+
+    time_gap = aggs.get('articles_over_time')
+    if time_gap and days is not None and rollup_bucket(0, time_gap['date_histogram']['interval']) is not None:
+        buckets = collections.Counter()
+        for day, count in days.items():
+            buckets[rollup_bucket(day, time_gap['date_histogram']['interval'])] += count
+        answered['articles_over_time'] = {'buckets': []}
+        for bucket in sorted(buckets):
+            date = EPOCH_DATE + datetime.timedelta(days=bucket)
+            answered['articles_over_time']['buckets'].append({
+                'key': bucket * 86400000,
+                'key_as_string': '{0:04d}-{1:02d}-{2:02d}T00:00:00+0000'.format(date.year, date.month, date.day),
+                'doc_count': buckets[bucket],
+            })
+
+    categories_aggs = aggs.get('registry_categories')
+    if categories_aggs and (first_day is None or days is not None):
+        categories = collections.Counter(rollup['categories'])
+        if first_day is not None:
+            categories = collections.Counter()
+            for day in days:
+                categories.update(rollup['day_categories'][day])
+        size = categories_aggs['aggs']['registry']['terms']['size']
+        # Same order of the terms aggregation: count descending, then term.
+        items = sorted(categories.items(), key=lambda item: (-item[1], item[0]))[:size]
+        answered['registry_categories'] = {
+            'registry': {'buckets': [{'key': key, 'doc_count': count} for key, count in items if count]}
+        }
+
+    for name in answered:
+        del aggs[name]
+    if not aggs:
+        dic_query.pop('aggs', None)
+
+    return answered or None
+
+
+def search_cache_key(validated_data, catalog, generation):
+    params = json.dumps(sorted(validated_data.items()), default=str)
+    key = '{0}|{1}|{2}'.format(catalog or '*', generation, params)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cached_search(serializer, catalog):
+    """Run elasticsearch() and return the JSON response, using the search cache when enabled.
+       Entries are keyed by the generation of the catalog, which changes on every write.
+    """
+    cache = get_search_cache()
+    # Scroll cursors move forward on every request, their pages are never cached.
+    if cache is None or 'scroll' in (serializer.validated_data.get('d_docs_cursor') or {}):
+        return json_dumps(elasticsearch(serializer, catalog))
+
+    key = search_cache_key(serializer.validated_data, catalog, cache.generation(catalog or '*'))
+    data = cache.get(key)
+    if data is None:
+        result = elasticsearch(serializer, catalog)
+        data = json_dumps(result)
+        # Errors are returned as (status, message) and are not cached.
+        if not isinstance(result, tuple):
+            cache.set(key, data)
+
+    return data
+
+
+def search_view(request, catalog=None):
+    request.GET = parse_get_params(request)
+    serializer = SearchSerializer(data=request.GET)
+    try:
+        serializer.is_valid(raise_exception=True)
+        data = cached_search(serializer, catalog)
+        status = 200
+    except serializers.ValidationError as error:
+        data = error
+        status = 400
+
+    return HttpResponse(data, status=status, content_type='application/json')
+
+
+def msearch(params_list, catalog):
+    """Run a list of searches with a single _msearch request.
+       Returns the response of every search in the same order, as elasticsearch() does.
+    """
+    es, version = es_connect(url=REGISTRY_SEARCH_URL)
+    es_version = int(version[0])
+
+    results = [None] * len(params_list)
+    batch = []
+    for position, params in enumerate(params_list):
+        serializer = SearchSerializer(data=dict((key.replace('.', '_'), value) for key, value in params.items()))
+        if not serializer.is_valid():
+            results[position] = 400, serializer.errors
+            continue
+        if serializer.validated_data.get('search_engine_endpoint') is not None:
+            # Searches on another Elasticsearch are sent on their own.
+            results[position] = elasticsearch(serializer, catalog)
+            continue
+        if serializer.validated_data.get('d_docs_cursor') is not None and es_version < 5:
+            results[position] = 400, {"error": {"msg": "d_docs_cursor needs Elasticsearch 5 in batch searches"}}
+            continue
+        try:
+            search_engine_endpoint, dic_query = compile_search(serializer, catalog, es, es_version)
+        except SearchError as e:
+            results[position] = e.status, e.error
+            continue
+        batch.append((position, serializer, search_engine_endpoint, dic_query))
+
+    if not batch:
+        return results
+
+    header = json.dumps({'index': catalog} if catalog else {})
+    lines = []
+    for _, _, _, dic_query in batch:
+        lines.extend([header, json.dumps(dic_query)])
+    try:
+        es_responses = es.post('_msearch', data='\n'.join(lines) + '\n')['responses']
+    except ElasticException as e:
+        es_responses = [{"error": str(e.args), "status": e.status_code}] * len(batch)
+
+    for (position, serializer, search_engine_endpoint, dic_query), es_response in zip(batch, es_responses):
+        if 'error' in es_response:
+            results[position] = es_response.get('status', 500), {"error": {"msg": str(es_response['error'])}}
+        else:
+            results[position] = shape_search(serializer, search_engine_endpoint, dic_query, es_response)
+
+    return results
+
+
+@csrf_exempt
+def msearch_view(request, catalog=None):
+    """Run the list of searches posted as a JSON array, each with the parameters of the search api.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        params_list = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        params_list = None
+    if not isinstance(params_list, list) or not all(isinstance(params, dict) for params in params_list):
+        data = {"error": {"msg": "The body must be a JSON array of search parameters"}}
+        return HttpResponse(json.dumps(data), status=400, content_type='application/json')
+
+    return HttpResponse(json_dumps(msearch(params_list, catalog)), content_type='application/json')
+
+
+EXPORT_CSV_FIELDS = ['layer_identifier', 'title', 'abstract', 'layer_originator', 'layer_date', 'source',
+                     'source_type', 'min_x', 'min_y', 'max_x', 'max_y', 'reliability_rate']
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+    'csv': 'text/csv',
+}
+
+
+def export_pages(serializer, catalog, page_size=REGISTRY_EXPORT_PAGE_SIZE):
+    """Yield the search responses of every page of documents matching a search.
+       Pages are read with a cursor and facets are not computed.
+    """
+    serializer.validated_data.update({
+        'd_docs_limit': page_size,
+        'd_docs_cursor': {},
+        'original_response': 0,
+        'a_time_limit': 0,
+        'a_time_gap': None,
+        'a_categories_limit': None,
+        'a_hm_limit': 0,
+    })
+    while True:
+        data = elasticsearch(serializer, catalog)
+        yield data
+        if not isinstance(data, dict) or data['d.docs.cursor'] is None:
+            return
+        serializer.validated_data['d_docs_cursor'] = decode_cursor(data['d.docs.cursor'])
+
+
+def doc_to_feature(doc):
+    geometry = None
+    # The bounding box can be left out of the documents with d_docs_fields.
+    if all(key in doc for key in ('min_x', 'min_y', 'max_x', 'max_y')):
+        geometry = {
+            'type': 'Polygon',
+            'coordinates': [[
+                [doc['min_x'], doc['min_y']], [doc['max_x'], doc['min_y']], [doc['max_x'], doc['max_y']],
+                [doc['min_x'], doc['max_y']], [doc['min_x'], doc['min_y']]
+            ]]
+        }
+
+    return {
+        'type': 'Feature',
+        'id': doc.get('layer_identifier'),
+        'geometry': geometry,
+        'properties': doc,
+    }
+
+
+def csv_line(values):
+    line = six.StringIO()
+    if six.PY2:
+        values = [value.encode('utf-8') if isinstance(value, six.text_type) else value for value in values]
+    csv.writer(line).writerow(values)
+    if six.PY2:
+        return line.getvalue().decode('utf-8')
+
+    return line.getvalue()
+
+
+def export_lines(pages, export_format):
+    """Yield the export of the documents of every page, one chunk per document.
+    """
+    if export_format == 'csv':
+        yield csv_line(EXPORT_CSV_FIELDS)
+    elif export_format == 'geojson':
+        yield '{"type": "FeatureCollection", "features": ['
+
+    separator = ''
+    for page in pages:
+        if not isinstance(page, dict):
+            # Headers are sent already, an error can only be logged and end the export.
+            LOGGER.error('Export stopped by search error: {0}'.format(page))
+            break
+        for doc in page['d.docs']:
+            if export_format == 'csv':
+                yield csv_line([doc.get(field, '') for field in EXPORT_CSV_FIELDS])
+            elif export_format == 'geojson':
+                yield separator + json_dumps(doc_to_feature(doc))
+                separator = ','
+            else:
+                yield json_dumps(doc) + '\n'
+
+    if export_format == 'geojson':
+        yield ']}'
+
+
+def gzip_lines(lines):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        chunk = compressor.compress(line.encode('utf-8'))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def export_view(request, export_format, catalog=None):
+    """Stream every document matching a search as NDJSON, a GeoJSON FeatureCollection or CSV.
+    """
+    request.GET = parse_get_params(request)
+    serializer = SearchSerializer(data=request.GET)
+    try:
+        serializer.is_valid(raise_exception=True)
+    except serializers.ValidationError as error:
+        return HttpResponse(error, status=400, content_type='application/json')
+
+    if export_format == 'csv' and 'd_docs_fields' not in request.GET:
+        serializer.validated_data['d_docs_fields'] = (EXPORT_CSV_FIELDS, [])
+    pages = export_pages(serializer, catalog)
+    # The first page is read before answering, so search errors keep their status.
+    first_page = next(pages)
+    if not isinstance(first_page, dict):
+        status, error = first_page
+        return HttpResponse(json.dumps(error), status=status, content_type='application/json')
+
+    lines = export_lines(itertools.chain([first_page], pages), export_format)
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = StreamingHttpResponse(gzip_lines(lines), content_type=EXPORT_CONTENT_TYPES[export_format])
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = StreamingHttpResponse((line.encode('utf-8') for line in lines),
+                                         content_type=EXPORT_CONTENT_TYPES[export_format])
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(catalog or 'registry', export_format)
+
+    return response
+
+
+def configure_mapproxy(extra_config, seed=False, ignore_warnings=True, renderd=False):
+    """Create an validate mapproxy configuration based on a dict.
+    """
+    # Start with a sane configuration using MapProxy's defaults
+    conf_options = load_default_config()
+
+    # Merge both
+    load_config(conf_options, config_dict=extra_config)
+
+    # Make sure the config is valid.
+    errors, informal_only = validate_options(conf_options)
+    for error in errors:
+        LOGGER.warn(error)
+    if errors and not ignore_warnings:
+        raise ConfigurationError('invalid configuration: %s' % ', '.join(errors))
+
+    errors = validate_references(conf_options)
+    for error in errors:
+        LOGGER.warn(error)
+    if errors and not ignore_warnings:
+        raise ConfigurationError('invalid references: %s' % ', '.join(errors))
+
+    conf = ProxyConfiguration(conf_options, seed=seed, renderd=renderd)
+
+    return conf
+
+
+LAYER_SRS_FOR_TYPE = {
+    'Hypermap:WARPER': 'EPSG:90013',
+    'ESRI:ArcGIS:MapServer': 'EPSG:3857',
+    'ESRI:ArcGIS:ImageServer': 'EPSG:3857',
+    'OGC:WMS': 'EPSG:4326'
+}
+
+GRID_SRS_FOR_TYPE = {
+    'Hypermap:WARPER': 'EPSG:90013',
+    'ESRI:ArcGIS:MapServer': 'EPSG:3857',
+    'ESRI:ArcGIS:ImageServer': 'EPSG:3857',
+    'OGC:WMS': 'EPSG:3857'
+}
+
+
+class RegistryMapProxyApp(MapProxyApp):
+    def welcome_response(self, script_url):
+        html = "<html><body><h1>Registry MapProxy</h1>"
+        html += "<h4>Version: %s</h4>" % version
+        if 'demo' in self.handlers:
+            html += ('<p>You can find services and sample openlayers configuration at:'
+                     '<a href="%s/demo/">demo</a>') % (script_url, )
+        return Response(html, mimetype='text/html')
+        pass
+
+
+def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_as_yaml=True, client_timeout=None):
+    """Creates a mapproxy config for a given layer-like object.
+       Compatible with django-registry and GeoNode.
+       client_timeout is the seconds MapProxy waits for the remote server.
+    """
+    bbox = list(wkt2geom(layer.wkt_geometry))
     bbox = ",".join([format(x, '.4f') for x in bbox])
     url = str(layer.source)
 
@@ -1403,8 +2897,8 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
         }
     }
 
-    # A cache that does not store for now. It needs a grid and a source.
-    # Do not enable cache before creating a ticket and discussing.
+    # A cache that does not store unless REGISTRY_MAPPROXY_CACHE_TYPE is set.
+    # It needs a grid and a source.
     caches = {
         'default_cache': {
             'disable_storage': True,
@@ -1412,6 +2906,10 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
             'sources': ['default_source']
         },
     }
+    layer_uuid = getattr(layer, 'identifier', None)
+    if REGISTRY_MAPPROXY_CACHE_TYPE and layer_uuid:
+        del caches['default_cache']['disable_storage']
+        caches['default_cache']['cache'] = layer_tile_cache(layer_uuid)
 
     # The layer is connected to the cache
     layers = [
@@ -1454,6 +2952,8 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
             'ssl_no_cert_checks': True
         },
     }
+    if client_timeout is not None:
+        global_config['http']['client_timeout'] = client_timeout
 
     # Populate a dictionary with custom config changes
     extra_config = {
@@ -1465,22 +2965,204 @@ def get_mapproxy(layer, seed=False, ignore_warnings=True, renderd=False, config_
         'globals': global_config,
     }
 
-    yaml_config = yaml.dump(extra_config, default_flow_style=False)
-    # If you want to test the resulting configuration. Turn on the next
-    # line and use that to generate a yaml config.
-    # assert False
-
     conf = configure_mapproxy(extra_config)
     # Create a MapProxy App
     app = RegistryMapProxyApp(conf.configured_services(), conf.base_config)
 
     # Wrap it in an object that allows to get requests by path as a string.
     if(config_as_yaml):
+        yaml_config = yaml.dump(extra_config, default_flow_style=False)
         return app, yaml_config
 
     return app, extra_config
 
 
+# MapProxy apps by layer uuid and modification date.
+MAPPROXY_APPS = LRUCache(maxsize=REGISTRY_MAPPROXY_CACHE_SIZE,
+                         maxweight=REGISTRY_MAPPROXY_CACHE_MEMORY * 1024 * 1024,
+                         weigh=lambda entry: estimate_size(entry['config']))
+
+
+def get_cached_mapproxy(layer, config_as_yaml=True):
+    """Same as get_mapproxy, reusing the app built for the same version of the layer.
+    """
+    key = (layer.identifier, layer.date_modified)
+    entry = MAPPROXY_APPS.get(key)
+    if entry is None:
+        app, extra_config = get_mapproxy(layer, config_as_yaml=False)
+        entry = {'app': app, 'config': extra_config, 'yaml': None}
+        MAPPROXY_APPS.set(key, entry)
+
+    if config_as_yaml:
+        if entry['yaml'] is None:
+            entry['yaml'] = yaml.dump(entry['config'], default_flow_style=False)
+        return entry['app'], entry['yaml']
+
+    return entry['app'], entry['config']
+
+
+def invalidate_layer(layer_uuid):
+    MAPPROXY_APPS.invalidate(lambda key: key[0] == layer_uuid)
+    if REGISTRY_MAPPROXY_CACHE_TYPE:
+        remove_layer_cache(layer_uuid)
+
+
+TILE_CACHE_FILES = {
+    'mbtiles': 'tiles.mbtiles',
+    'geopackage': 'tiles.gpkg',
+}
+
+
+def tile_cache_root():
+    return os.path.join(MAPPROXY_CACHE_DIR, 'registry_tiles')
+
+
+def layer_cache_dir(layer_uuid):
+    return os.path.join(tile_cache_root(), layer_uuid)
+
+
+def layer_tile_cache(layer_uuid):
+    """MapProxy cache storage options for a layer, one directory per layer.
+    """
+    directory = layer_cache_dir(layer_uuid)
+    cache = {
+        'type': REGISTRY_MAPPROXY_CACHE_TYPE,
+        'tile_lock_dir': os.path.join(directory, 'locks'),
+    }
+    if REGISTRY_MAPPROXY_CACHE_TYPE in TILE_CACHE_FILES:
+        cache['filename'] = os.path.join(directory, TILE_CACHE_FILES[REGISTRY_MAPPROXY_CACHE_TYPE])
+    else:
+        cache['directory'] = os.path.join(directory, 'tiles')
+
+    return cache
+
+
+def remove_layer_cache(layer_uuid):
+    directory = layer_cache_dir(layer_uuid)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Last time each layer cache was marked as used by this process.
+LAYER_CACHE_USED = {}
+TILE_CACHE_PRUNER = []
+
+
+def touch_layer_cache(layer_uuid, interval=60):
+    """Mark the tile cache of a layer as used, at most once per interval seconds.
+    """
+    now = time.time()
+    if now - LAYER_CACHE_USED.get(layer_uuid, 0) < interval:
+        return
+    LAYER_CACHE_USED[layer_uuid] = now
+
+    directory = layer_cache_dir(layer_uuid)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    created = os.path.join(directory, 'created')
+    if not os.path.exists(created):
+        open(created, 'w').close()
+    with open(os.path.join(directory, 'last_used'), 'w'):
+        pass
+
+    if REGISTRY_MAPPROXY_CACHE_PRUNE_INTERVAL > 0 and not TILE_CACHE_PRUNER:
+        thread = threading.Thread(target=prune_tile_cache_forever, name='registry-tile-pruner')
+        thread.daemon = True
+        TILE_CACHE_PRUNER.append(thread)
+        thread.start()
+
+
+def prune_tile_cache_forever():
+    while True:
+        time.sleep(REGISTRY_MAPPROXY_CACHE_PRUNE_INTERVAL)
+        try:
+            prune_tile_cache()
+        except Exception as e:
+            LOGGER.error('Tile cache pruning failed: {0}'.format(e))
+
+
+def cache_files(directory):
+    """Return (mtime, size, path) for every tile file under directory.
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    return files
+
+
+def marker_time(directory, *names):
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+
+    return os.path.getmtime(directory)
+
+
+def prune_layer_cache(layer_uuid, now):
+    """Apply expiration and the per-layer size cap to a layer cache.
+       File caches lose their oldest tiles, single file caches are removed as a whole.
+    """
+    directory = layer_cache_dir(layer_uuid)
+    single_file = REGISTRY_MAPPROXY_CACHE_TYPE != 'file'
+    tiles_dir = os.path.join(directory, 'tiles')
+    ttl = REGISTRY_MAPPROXY_CACHE_TTL
+    cap = REGISTRY_MAPPROXY_LAYER_CACHE_MB * 1024 * 1024
+
+    if single_file:
+        size = sum(size for _, size, _ in cache_files(directory))
+        if (ttl and now - marker_time(directory, 'created') > ttl) or (cap and size > cap):
+            invalidate_layer(layer_uuid)
+        return
+
+    tiles = sorted(cache_files(tiles_dir))
+    if ttl:
+        expired = [tile for tile in tiles if now - tile[0] > ttl]
+        for _, _, path in expired:
+            os.remove(path)
+        tiles = tiles[len(expired):]
+    if cap:
+        size = sum(tile[1] for tile in tiles)
+        while tiles and size > cap:
+            _, tile_size, path = tiles.pop(0)
+            os.remove(path)
+            size -= tile_size
+
+
+def prune_tile_cache(now=None):
+    """Expire tiles, apply per-layer caps and remove least recently used
+       layer caches while the total size is above REGISTRY_MAPPROXY_CACHE_QUOTA_MB.
+    """
+    root = tile_cache_root()
+    if not os.path.isdir(root):
+        return
+
+    now = now or time.time()
+    layers = []
+    for layer_uuid in os.listdir(root):
+        prune_layer_cache(layer_uuid, now)
+        directory = layer_cache_dir(layer_uuid)
+        if os.path.isdir(directory):
+            size = sum(size for _, size, _ in cache_files(directory))
+            layers.append((marker_time(directory, 'last_used', 'created'), size, layer_uuid))
+
+    quota = REGISTRY_MAPPROXY_CACHE_QUOTA_MB * 1024 * 1024
+    total = sum(layer[1] for layer in layers)
+    for _, size, layer_uuid in sorted(layers):
+        if not quota or total <= quota:
+            break
+        LOGGER.debug('Removing tile cache of layer {0}'.format(layer_uuid))
+        invalidate_layer(layer_uuid)
+        total -= size
+
+
 def environ_from_url(path, request=None):
     """From webob.request
     TOD: Add License.
@@ -1533,15 +3215,27 @@ def get_path_info_params(yaml_text):
     return bbox_req, lay_name
 
 
+# One repository per thread, pycsw sessions can not be shared between threads.
+REPOSITORIES = threading.local()
+
+
+def get_repository():
+    repository = getattr(REPOSITORIES, 'repository', None)
+    if repository is None:
+        repository = RegistryRepository()
+        REPOSITORIES.repository = repository
+
+    return repository
+
+
 def layer_from_csw(layer_uuid):
     # Get Layer with matching catalog and primary key
-    repository = RegistryRepository()
-    layer_ids = repository.query_ids([layer_uuid])
-    layer = None
-    if len(layer_ids) > 0:
-        layer = layer_ids[0]
-
-    return layer
+    try:
+        return get_repository().get_record_by_id(layer_uuid)
+    except Exception:
+        # Start with a new repository next time, the session may be unusable.
+        REPOSITORIES.repository = None
+        raise
 
 
 '''
@@ -1561,8 +3255,8 @@ def layer_json_view(request, layer_uuid):
         return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
 
     # Set up a mapproxy app for this particular layer
-    _, config = get_mapproxy(layer, config_as_yaml=False)
-    json_contents = json.dumps(config)
+    _, config = get_cached_mapproxy(layer, config_as_yaml=False)
+    json_contents = json_dumps(config)
 
     response = HttpResponse(json_contents, content_type='application/json')
 
@@ -1575,7 +3269,7 @@ def layer_yml_view(request, layer_uuid):
         return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
 
     # Set up a mapproxy app for this particular layer
-    _, yaml_config = get_mapproxy(layer)
+    _, yaml_config = get_cached_mapproxy(layer)
 
     response = HttpResponse(yaml_config, content_type='text/plain')
 
@@ -1615,31 +3309,191 @@ def get_mapproxy_png(yaml_text, mp):
     return app_iter
 
 
+def thumbnail_path(layer):
+    """Thumbnails are stored by layer uuid and a hash of the layer mapproxy config.
+    """
+    _, config = get_cached_mapproxy(layer, config_as_yaml=False)
+    config_hash = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    return os.path.join(MAPPROXY_CACHE_DIR, 'registry_thumbnails', '{0}-{1}.png'.format(layer.identifier, config_hash))
+
+
+def render_thumbnail(layer):
+    """Render the thumbnail of a layer with the configured exception format.
+       Returns the content and whether the remote service failed.
+    """
+    mp, config = get_cached_mapproxy(layer, config_as_yaml=False)
+    content = next(get_mapproxy_png(config, mp))
+    if 'ServiceException' in str(content):
+        return content, True
+    if MAPPROXY_ERROR_IMAGES:
+        # Error images have the message written in a single color over the background.
+        try:
+            return content, image_stats([PIL.Image.open(BytesIO(content))])[0].colors == 2
+        except IOError:
+            return content, True
+
+    return content, False
+
+
+def store_thumbnail(path, content):
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+
+    # Previous versions of the thumbnail belong to older configurations.
+    layer_uuid = os.path.basename(path).rsplit('-', 1)[0]
+    for old_path in glob.glob(os.path.join(folder, '{0}-*.png'.format(layer_uuid))):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                # Removed by a concurrent render of the same layer.
+                pass
+
+    temp_path = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.rename(temp_path, path)
+
+
+THUMBNAILS_REFRESHING = set()
+THUMBNAILS_LOCK = threading.Lock()
+
+
+def refresh_thumbnail(layer, path):
+    """Render a stale thumbnail again in a background thread, once at a time per layer.
+    """
+    with THUMBNAILS_LOCK:
+        if path in THUMBNAILS_REFRESHING:
+            return
+        THUMBNAILS_REFRESHING.add(path)
+
+    def refresh():
+        try:
+            content, failed = render_thumbnail(layer)
+            if not failed:
+                store_thumbnail(path, content)
+        except Exception as e:
+            LOGGER.error('Thumbnail of layer {0} could not be refreshed: {1}'.format(layer.identifier, e))
+        finally:
+            with THUMBNAILS_LOCK:
+                THUMBNAILS_REFRESHING.discard(path)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def etag_matches(if_none_match, etag):
+    """Compare the entity tags of an If-None-Match header with etag, ignoring weakness (RFC 7232).
+    """
+    for tag in parse_etags(if_none_match):
+        # Django 1.9 returns the tags without quotes, later versions keep them and the W/ prefix.
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag in ('*', etag, etag.strip('"')):
+            return True
+
+    return False
+
+
+def thumbnail_response(request, path):
+    modified = int(os.path.getmtime(path))
+    etag = '"{0}-{1}"'.format(os.path.basename(path)[:-len('.png')], modified)
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        not_modified = bool(if_modified_since and if_modified_since >= modified)
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        with open(path, 'rb') as f:
+            response = HttpResponse(f.read(), content_type='image/png')
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+
+    return response
+
+
 def layer_png_view(request, layer_uuid):
     layer = layer_from_csw(layer_uuid)
     if not layer:
         return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
 
-    # Set up a mapproxy app for this particular layer
-    mp, yaml_config = get_mapproxy(layer)
-    yaml_text = yaml.load(yaml_config)
+    path = thumbnail_path(layer)
+    if os.path.exists(path):
+        if time.time() - os.path.getmtime(path) > REGISTRY_THUMBNAIL_TTL:
+            refresh_thumbnail(layer, path)
+        return thumbnail_response(request, path)
 
-    app_iter = get_mapproxy_png(yaml_text, mp)
+    response_content, failed = render_thumbnail(layer)
+    if not failed:
+        store_thumbnail(path, response_content)
+        return thumbnail_response(request, path)
 
-    response_content = next(app_iter)
+    # Errors are not stored.
     if 'ServiceException' in str(response_content):
         return HttpResponse(response_content, content_type='application/xml', status=500)
 
     return HttpResponse(response_content, content_type='image/png')
 
 
+def prerender_thumbnail(layer_uuid):
+    try:
+        layer = layer_from_csw(layer_uuid)
+        if not layer:
+            return 0
+        path = thumbnail_path(layer)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) <= REGISTRY_THUMBNAIL_TTL:
+            return 0
+        content, failed = render_thumbnail(layer)
+        if failed:
+            LOGGER.warn('Thumbnail of layer {0} could not be rendered'.format(layer_uuid))
+            return 0
+        store_thumbnail(path, content)
+    except Exception as e:
+        LOGGER.error('Thumbnail of layer {0} could not be rendered: {1}'.format(layer_uuid, e))
+        return 0
+
+    return 1
+
+
+def render_thumbnails(catalog_slug, workers=REGISTRY_THUMBNAIL_WORKERS):
+    """Render missing and stale thumbnails of every layer of a catalog.
+    """
+    es, _ = es_connect(url=REGISTRY_SEARCH_URL)
+    query = {"query": {"match_all": {}}, "_source": ["layer_identifier"]}
+    uuids = (hit['_source']['layer_identifier'] for hit in scroll_documents(es, catalog_slug, query))
+
+    pool = ThreadPool(workers)
+    try:
+        rendered = sum(pool.imap_unordered(prerender_thumbnail, uuids, chunksize=10))
+    finally:
+        pool.close()
+        pool.join()
+    LOGGER.debug('{0} thumbnails rendered for catalog {1}'.format(rendered, catalog_slug))
+
+    return rendered
+
+
 def layer_mapproxy(request, layer_uuid, path_info):
     layer = layer_from_csw(layer_uuid)
     if not layer:
         return HttpResponse("Layer with uuid {0} not found.".format(layer_uuid), status=404)
 
     # Set up a mapproxy app for this particular layer
-    mp, yaml_config = get_mapproxy(layer)
+    mp, _ = get_cached_mapproxy(layer, config_as_yaml=False)
+    if REGISTRY_MAPPROXY_CACHE_TYPE:
+        touch_layer_cache(layer_uuid)
 
     query = request.META['QUERY_STRING']
 
@@ -1680,13 +3534,11 @@ def create_response_dict(catalog_id, catalog):
 
 
 def list_catalogs_view(request):
-    es, _ = es_connect(url=REGISTRY_SEARCH_URL)
-
-    list_catalogs = es.get('_aliases').keys()
-    response_list = [create_response_dict(i, catalog) for i, catalog in enumerate(list_catalogs)]
-    message, status = json.dumps(response_list), 200
+    catalogs = list_catalogs()
+    response_list = [create_response_dict(i, catalog) for i, catalog in enumerate(catalogs)]
+    message, status = json_dumps(response_list), 200
 
-    if len(list_catalogs) == 0:
+    if len(catalogs) == 0:
         message, status = 'Empty list of catalogs', 404
 
     response = HttpResponse(message, status=status, content_type='application/json')
@@ -1705,15 +3557,18 @@ def readme_view(request):
     return response
 
 
+# Style of the HTML error pages some servers return instead of their capabilities.
+HTML_ERROR_SIGNATURE = 'h1 { font-weight:normal; }'
+
+
 def check_config(layer_uuid, yaml_config, folder):
     yml_file = os.path.join(folder, '%s.yml' % layer_uuid)
     if os.path.exists(yml_file):
         return 0
-    if 'h1 { font-weight:normal; }' in yaml_config:
+    if HTML_ERROR_SIGNATURE in yaml_config:
         return 1
 
-    config_dict = yaml.load(yaml_config)
-    if config_dict['sources']['default_source']['req']['url'] is None:
+    if check_config_dict(yaml.load(yaml_config)) == 1:
         return 1
     if not os.path.isdir(folder):
         os.mkdir(folder)
@@ -1723,6 +3578,25 @@ def check_config(layer_uuid, yaml_config, folder):
     return 0
 
 
+def check_config_dict(config):
+    """Return 1 when a MapProxy configuration has no source url or holds an HTML error page.
+    """
+    if config['sources']['default_source']['req']['url'] is None:
+        return 1
+
+    values = [config]
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, six.string_types) and HTML_ERROR_SIGNATURE in value:
+            return 1
+
+    return 0
+
+
 def check_bbox(yml_config):
     if 'services' not in yml_config:
         return 1
@@ -1758,72 +3632,255 @@ def check_bbox(yml_config):
 
 
 def layer_image(uuid):
-    valid_image, check_color = 0, 0
     layer = layer_from_csw(uuid)
-    mp, yaml_config = get_mapproxy(layer)
-    yaml_text = yaml.load(yaml_config)
+    mp, yaml_config = get_mapproxy(layer, config_as_yaml=False)
+
+    return check_layer_image(mp, yaml_config)
 
-    app_iter = get_mapproxy_png(yaml_text, mp)
 
-    bytes_img = BytesIO(next(app_iter))
-    img = PIL.Image.open(bytes_img)
+# Grayscale statistics of a layer image: number of distinct values, fraction of
+# pixels with the lightest and the darkest value and entropy of the histogram.
+ImageStats = collections.namedtuple('ImageStats', ['colors', 'blank', 'dark', 'entropy'])
 
-    check_color = check_image(img)
 
-    return valid_image, check_color
+def image_stats(images):
+    """Return the ImageStats of a list of images. The histograms are computed by PIL
+       and, when NumPy is installed, the statistics of all of them at once.
+    """
+    histograms = [img.convert('L').histogram() for img in images]
+    if not histograms:
+        return []
 
+    if numpy is None:
+        return [histogram_stats(histogram) for histogram in histograms]
 
-def check_image(img):
-    img_colors = img.convert('L').getcolors()
-    # For testing, image resolution is 200*150=30000 pixels.
-    # getcolor function retrieves the number of ocurrences per pixel value.
-    # Verify that is an image with error. Only two pixel values.
-    if len(img_colors) == 2:
+    counts = numpy.array(histograms, dtype=numpy.float64)
+    present = counts > 0
+    rows = numpy.arange(len(counts))
+    pixels = counts.sum(axis=1)
+    lightest = 255 - present[:, ::-1].argmax(axis=1)
+    darkest = present.argmax(axis=1)
+    frequencies = counts / pixels[:, None]
+    # Bins without pixels add nothing to the entropy.
+    logs = numpy.log2(numpy.where(present, frequencies, 1))
+    entropy = -(frequencies * logs).sum(axis=1)
+
+    return [ImageStats(int(colors), float(blank), float(dark), float(bits)) for colors, blank, dark, bits in zip(
+        present.sum(axis=1), counts[rows, lightest] / pixels, counts[rows, darkest] / pixels, entropy)]
+
+
+def histogram_stats(histogram):
+    pixels = float(sum(histogram))
+    values = [value for value, count in enumerate(histogram) if count]
+    entropy = -sum(histogram[value] / pixels * math.log(histogram[value] / pixels, 2) for value in values)
+
+    return ImageStats(len(values), histogram[values[-1]] / pixels, histogram[values[0]] / pixels, entropy)
+
+
+def image_check(stats):
+    """Return check_color of an image from its ImageStats: 1 for error, blank and dark images.
+    """
+    # Error images have the message written in a single color over the background.
+    if stats.colors == 2:
         return 1
-    # Verify that most of pixels are not 255 (blank image).
-    ocurrences, pixel_value = img_colors[-1]
-    if ocurrences > 29950:
+    if stats.blank > REGISTRY_CHECK_BLANK_FRACTION or stats.dark > REGISTRY_CHECK_BLANK_FRACTION:
         return 1
-    # Verify that most of pixels are not 0 (dark image).
-    ocurrences, pixel_value = img_colors[0]
-    if ocurrences > 29950:
+    if stats.entropy < REGISTRY_CHECK_MIN_ENTROPY:
         return 1
 
     return 0
 
 
-def check_layer(uuid, yml_folder='yml'):
+def check_images(images):
+    return [image_check(stats) for stats in image_stats(images)]
+
+
+def check_image(img):
+    return check_images([img])[0]
+
+
+def check_layer(uuid, archive=None):
+    valid_bbox, valid_config, layer, mp, config = prepare_layer_check(uuid, archive=archive)
+    valid_image, check_color = 1, 1
+    if valid_bbox != 1:
+        valid_image, check_color = check_layer_image(mp, config)
+
+    return valid_bbox, valid_config, valid_image, check_color
+
+
+def prepare_layer_check(uuid, client_timeout=None, archive=None):
+    """Check the configuration and bounding box of a layer without contacting its server.
+       Returns valid_bbox, valid_config and the layer, MapProxy app and configuration needed
+       to check its image. Valid configurations are added to archive, a ConfigArchive.
+    """
     layer = layer_from_csw(uuid)
-    _, yaml_config = get_mapproxy(layer)
-    valid_config, valid_bbox, check_color = check_config(uuid, yaml_config, yml_folder), 1, 1
-    netloc_counter = 9999
+    mp, config = get_mapproxy(layer, config_as_yaml=False, client_timeout=client_timeout)
+    valid_config, valid_bbox = check_config_dict(config), 1
 
     if valid_config != 1:
-        netloc = check_netloc(layer)
-        netloc_counter = netlocs_dic[netloc]['counter']
-        yml_file = os.path.join(yml_folder, '%s.yml' % uuid)
+        valid_bbox = check_bbox(config)
+        if archive is not None:
+            archive.add(uuid, config)
 
-        with open(yml_file, 'rb') as f:
-            yml_config = yaml.load(f)
+    return valid_bbox, valid_config, layer, mp, config
 
-        valid_bbox, valid_image = check_bbox(yml_config), 1
 
-    if valid_bbox != 1 and netloc_counter <= REGISTRY_MAXRECORDS_PER_NETLOC:
-        valid_image, check_color = layer_image(uuid)
+class ConfigArchive(object):
+    """Zip file collecting the MapProxy configurations of the layers checked in a run,
+       as the <uuid>.yml files check_config writes one by one.
+    """
+    def __init__(self, path):
+        self.zip_file = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.lock = threading.Lock()
 
-    return valid_bbox, valid_config, valid_image, check_color
+    def add(self, uuid, config):
+        yaml_config = yaml.dump(config, default_flow_style=False)
+        with self.lock:
+            self.zip_file.writestr('{0}.yml'.format(uuid), yaml_config)
 
+    def close(self):
+        with self.lock:
+            self.zip_file.close()
 
-def check_netloc(layer):
-    netloc = urlparse(layer.source).netloc
-    if netloc in netlocs_dic.keys():
-        netlocs_dic[netloc]['counter'] += 1
-    else:
-        netlocs_dic[netloc] = {
-            'counter': 1
-        }
 
-    return netloc
+def check_layer_image(mp, yaml_text):
+    """Return valid_image and check_color of the GetMap image of a layer MapProxy app.
+    """
+    try:
+        img = PIL.Image.open(BytesIO(next(get_mapproxy_png(yaml_text, mp))))
+        return 0, check_image(img)
+    except Exception as e:
+        LOGGER.warn('Layer image could not be checked: {0}'.format(e))
+        return 1, 1
+
+
+class NetlocLimiter(object):
+    """Limits the concurrent requests and the request rate to each remote server.
+
+       A task that finds its server busy is deferred, it is handed to the next
+       task of that server releasing its slot, so workers never wait on a busy
+       server while other servers have layers to check. Deferred tasks should be
+       small, as every layer of a busy server may be waiting.
+    """
+    def __init__(self, concurrency=REGISTRY_CHECK_NETLOC_CONCURRENCY, rate=REGISTRY_CHECK_NETLOC_RATE):
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.active = collections.Counter()
+        self.next_time = {}
+        self.deferred = collections.defaultdict(collections.deque)
+
+    def reserve(self, netloc):
+        # Called with the lock held.
+        now = time.time()
+        start = max(now, self.next_time.get(netloc, 0))
+        self.next_time[netloc] = start + self.interval
+        return start - now
+
+    def acquire(self, netloc, task):
+        """Return the seconds to wait before the request of task is sent to netloc,
+           or None when netloc is busy and task was deferred.
+        """
+        with self.lock:
+            if self.active[netloc] >= self.concurrency:
+                self.deferred[netloc].append(task)
+                return None
+            self.active[netloc] += 1
+            return self.reserve(netloc)
+
+    def release(self, netloc):
+        """Return the next deferred task of netloc, which takes over the released slot,
+           and the seconds it has to wait. Returns (None, None) when there is none.
+        """
+        with self.lock:
+            deferred = self.deferred.get(netloc)
+            if deferred:
+                task = deferred.popleft()
+                if not deferred:
+                    del self.deferred[netloc]
+                return task, self.reserve(netloc)
+            self.active[netloc] -= 1
+            if not self.active[netloc]:
+                del self.active[netloc]
+                self.next_time.pop(netloc, None)
+
+            return None, None
+
+
+def check_layers(uuids, workers=REGISTRY_CHECK_WORKERS, limiter=None, client_timeout=REGISTRY_CHECK_TIMEOUT,
+                 archive=None):
+    """Check layers concurrently, yields (uuid, valid_bbox, valid_config, valid_image, check_color,
+       unix timestamp) as checks complete. Requests to the remote servers are limited by limiter
+       and the configurations of the layers are added to archive, a ConfigArchive.
+    """
+    limiter = limiter or NetlocLimiter()
+    tasks = queue.Queue(maxsize=workers * 2)
+    results = queue.Queue()
+
+    def feed():
+        for uuid in uuids:
+            tasks.put(uuid.strip())
+        for _ in range(workers):
+            tasks.put(None)
+
+    def finish(uuid, valid_bbox, valid_config, valid_image, check_color):
+        results.put((uuid, valid_bbox, valid_config, valid_image, check_color, int(time.time())))
+
+    def prepare(uuid):
+        # Deferred layers only keep their uuid, their MapProxy app is built when they get a slot.
+        try:
+            valid_bbox, valid_config, _, mp, config = prepare_layer_check(uuid, client_timeout)
+        except Exception as e:
+            LOGGER.warn('Layer {0} could not be checked: {1}'.format(uuid, e))
+            finish(uuid, 1, 1, 1, 1)
+            return None
+
+        return uuid, valid_bbox, valid_config, mp, config
+
+    def fetch(netloc, prepared, wait):
+        # The layer holds a slot of its server until its image is checked.
+        while prepared is not None:
+            uuid, valid_bbox, valid_config, mp, config = prepared
+            if wait:
+                time.sleep(wait)
+            finish(uuid, valid_bbox, valid_config, *check_layer_image(mp, config))
+            prepared = None
+            while prepared is None:
+                uuid, wait = limiter.release(netloc)
+                if uuid is None:
+                    return
+                prepared = prepare(uuid)
+
+    def work():
+        for uuid in iter(tasks.get, None):
+            try:
+                valid_bbox, valid_config, layer, mp, config = prepare_layer_check(uuid, client_timeout, archive)
+            except Exception as e:
+                LOGGER.warn('Layer {0} could not be checked: {1}'.format(uuid, e))
+                finish(uuid, 1, 1, 1, 1)
+                continue
+            if valid_bbox == 1:
+                finish(uuid, valid_bbox, valid_config, 1, 1)
+                continue
+            netloc = urlparse(layer.source).netloc
+            wait = limiter.acquire(netloc, uuid)
+            if wait is not None:
+                fetch(netloc, (uuid, valid_bbox, valid_config, mp, config), wait)
+        results.put(None)
+
+    threads = [threading.Thread(target=feed, name='registry-check-feeder')]
+    threads.extend(threading.Thread(target=work, name='registry-check-{0}'.format(i)) for i in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    while finished < workers:
+        result = results.get()
+        if result is None:
+            finished += 1
+        else:
+            yield result
 
 
 def parse_values_from_string(line):
@@ -1844,11 +3901,16 @@ def parse_values_from_string(line):
 
 
 def get_data_from_es(es, uuid):
+    # Documents are indexed with the layer uuid as id, the term query finds
+    # the ones indexed before that.
     query_dic = {
+        "size": 1,
         "query": {
-            "query_string": {
-                "fields": ["layer_identifier"],
-                "query": uuid
+            "bool": {
+                "should": [
+                    {"ids": {"type": "layer", "values": [uuid]}},
+                    {"term": {"layer_identifier": uuid}}
+                ]
             }
         }
     }
@@ -1876,6 +3938,71 @@ def compute_reliability(list_dictionaries):
     return (float(reliability) / len(list_dictionaries)) * 100
 
 
+def get_reliability_docs(es, uuids, catalogs):
+    """Return the (index, id, checks_list) of the documents of each layer uuid, in every catalog.
+       Documents are read by id with a single _mget, the ones indexed before layers used
+       their uuid as id are searched by layer_identifier.
+    """
+    source = ['layer_identifier', 'checks_list']
+    docs = collections.defaultdict(list)
+    mget_docs = [{'_index': catalog, '_type': 'layer', '_id': uuid, '_source': source}
+                 for catalog in catalogs for uuid in uuids]
+    if mget_docs:
+        for doc in es.post('_mget', data={'docs': mget_docs})['docs']:
+            if doc.get('found'):
+                docs[doc['_id']].append((doc['_index'], doc['_id'], doc['_source'].get('checks_list', [])))
+
+    missing = [uuid for uuid in uuids if uuid not in docs]
+    if missing:
+        query_dic = {
+            'size': len(missing) * max(len(catalogs), 1),
+            '_source': source,
+            'query': {'terms': {'layer_identifier': missing}}
+        }
+        for hit in es.post('_search', data=query_dic)['hits']['hits']:
+            docs[hit['_source']['layer_identifier']].append(
+                (hit['_index'], hit['_id'], hit['_source'].get('checks_list', [])))
+
+    return docs
+
+
+def update_reliability(es, lines, batch_size=REGISTRY_RELIABILITY_BATCH_SIZE):
+    """Add the checks of lines written by check_layers to the layers and update their reliability_rate.
+       Each batch of lines is read with one _mget and written with partial updates in one _bulk request.
+       Returns the number of documents updated and the list of (action, document, error) rejected.
+    """
+    catalogs = list_catalogs(es)
+    lines = (line for line in lines if line.strip())
+    updated, failed = 0, []
+    while True:
+        batch = [parse_values_from_string(line.strip()) for line in itertools.islice(lines, batch_size)]
+        if not batch:
+            break
+
+        docs = get_reliability_docs(es, list(collections.OrderedDict.fromkeys(uuid for uuid, _ in batch)), catalogs)
+        checks = collections.OrderedDict()
+        for uuid, reliability_dic in batch:
+            if uuid not in docs:
+                LOGGER.warn('Layer {0} not found in elasticsearch'.format(uuid))
+            for index_name, layer_id, checks_list in docs.get(uuid, []):
+                key = (index_name, layer_id)
+                checks[key] = add_dict_to_list(checks.get(key, checks_list), reliability_dic)
+
+        actions = []
+        for (index_name, layer_id), checks_list in checks.items():
+            doc = {'checks_list': checks_list, 'reliability_rate': compute_reliability(checks_list)}
+            actions.append((bulk_action('update', index_name, layer_id), {'doc': doc}))
+        if actions:
+            batch_failed = bulk_index(es, actions)
+            failed.extend(batch_failed)
+            updated += len(actions) - len(batch_failed)
+            for catalog in catalogs:
+                invalidate_search_cache(catalog)
+        LOGGER.debug('{0} layers updated with {1} checks'.format(len(actions), len(batch)))
+
+    return updated, failed
+
+
 def api_config_view(request):
     with open('search_api.yaml', 'r') as f:
         response = HttpResponse(f, content_type='text/plain')
@@ -1883,23 +4010,392 @@ def api_config_view(request):
     return response
 
 
-def index_with_bulk(catalog_slug, data_dict):
-    es_endpoint = '{0}/layer/_bulk'.format(catalog_slug)
+def index_with_bulk(catalog_slug, docs):
     es, _ = es_connect(url=REGISTRY_SEARCH_URL)
-    bulk_body = '{"index":{}}\n' + '\n{"index":{}}\n'.join(data_dict) + '\n{"index":{}}'
-    es.post(es_endpoint, data=bulk_body)
+    actions = [(bulk_action('index', catalog_slug, doc['layer_identifier']), doc) for doc in docs]
+    failed = bulk_index(es, actions)
+    for action, doc, error in failed:
+        LOGGER.error('Layer {0} was not indexed: {1}'.format(doc['layer_identifier'], error))
+
+    return failed
+
+
+RECORD_FIELDS = ['identifier', 'title', 'title_alternate', 'abstract', 'wkt_geometry', 'source',
+                 'type', 'date_modified', 'creator', 'format', 'xml', 'links']
+
 
+class RecordRow(object):
+    """Picklable copy of the record columns used by record_to_dict.
+    """
+    def __init__(self, record):
+        for field in RECORD_FIELDS:
+            setattr(self, field, getattr(record, field))
+
+
+def records_to_docs(records):
+    return [record_to_dict(record) for record in records]
 
-def re_index_layers(catalog_slug):
-    # Fetching number of records.
+
+class ReindexProgress(object):
+    """Counts indexed documents and keeps the checkpoint of a reindex.
+
+       Batches may finish out of order, the checkpoint is the last identifier
+       of the longest run of finished batches. A batch with failed documents
+       never finishes, so a resumed reindex retries it.
+    """
+    def __init__(self, catalog_slug, checkpoint_file, report_interval=10):
+        self.catalog_slug = catalog_slug
+        self.checkpoint_file = checkpoint_file
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.started = self.reported = time.time()
+        self.indexed = 0
+        self.failed = 0
+        self.failed_batches = 0
+        self.next_batch = 0
+        self.finished = {}
+
+    def batch_done(self, batch, last_identifier, count, failed):
+        with self.lock:
+            self.indexed += count - failed
+            self.failed += failed
+            if failed:
+                self.failed_batches += 1
+            else:
+                self.finished[batch] = last_identifier
+
+            committed = None
+            while self.next_batch in self.finished:
+                committed = self.finished.pop(self.next_batch)
+                self.next_batch += 1
+            if committed is not None:
+                with open(self.checkpoint_file, 'w') as f:
+                    f.write(committed)
+
+            if time.time() - self.reported >= self.report_interval:
+                self.report()
+
+    def report(self):
+        self.reported = time.time()
+        rate = self.indexed / max(self.reported - self.started, 0.001)
+        LOGGER.info('Reindex {0}: {1} documents indexed, {2} failed, {3:.0f} docs/sec'.format(
+            self.catalog_slug, self.indexed, self.failed, rate))
+
+    def close(self):
+        """Remove the checkpoint once every batch is indexed.
+        """
+        self.report()
+        if self.failed_batches:
+            LOGGER.error('Reindex {0}: {1} batches failed, resume from {2}'.format(
+                self.catalog_slug, self.failed_batches, self.checkpoint_file))
+        elif os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+
+def re_index_layers(catalog_slug, resume=False, workers=REGISTRY_REINDEX_WORKERS,
+                    senders=REGISTRY_REINDEX_SENDERS):
+    """Index every record of the pycsw database into a catalog.
+
+       Records are read by pages, converted by a pool of processes and sent
+       by several threads while the next pages are read. With resume, the
+       reindex starts after the last identifier committed by a previous run.
+       Returns the number of documents indexed and failed.
+    """
+    checkpoint_file = os.path.join(REGISTRY_REINDEX_CHECKPOINT_DIR,
+                                   'registry_reindex_{0}.checkpoint'.format(catalog_slug))
+    start_after = None
+    if resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            start_after = f.read().strip() or None
+        LOGGER.info('Resuming reindex of {0} after record {1}'.format(catalog_slug, start_after))
+
+    progress = ReindexProgress(catalog_slug, checkpoint_file)
+    # Bounded, so at most senders bulk requests wait for a free thread.
+    send_queue = queue.Queue(maxsize=senders)
+
+    def send():
+        while True:
+            item = send_queue.get()
+            if item is None:
+                return
+            batch, last_identifier, docs = item
+            try:
+                failed = len(index_with_bulk(catalog_slug, docs)) if docs else 0
+            except Exception as e:
+                LOGGER.error('Batch ending at record {0} was not indexed: {1}'.format(last_identifier, e))
+                failed = max(len(docs), 1)
+            progress.batch_done(batch, last_identifier, len(docs), failed)
+
+    # The pool is forked before the sender threads start.
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    threads = [threading.Thread(target=send) for _ in range(senders)]
+    for thread in threads:
+        thread.start()
+
+    converting = collections.deque()
     repo = RegistryRepository()
-    size, _ = repo.query('')
-    # Loop retreiving records from db and send to es.
-    for start_position in range(0, int(size), REGISTRY_CSW_MAX_RECORDS):
-        LOGGER.debug('Retrieving records from position {0}'.format(start_position))
-        records_list = repo.query('', startposition=start_position, maxrecords=REGISTRY_CSW_MAX_RECORDS)[1]
-        data_dict = [json.dumps(record_to_dict(record)) for record in records_list if record.wkt_geometry]
-        index_with_bulk(catalog_slug, data_dict)
+    try:
+        for batch, page in enumerate(repo.iter_records(after=start_after)):
+            LOGGER.debug('Retrieving records after {0}'.format(page[0].identifier))
+            rows = [RecordRow(record) for record in page if record.wkt_geometry]
+            if pool is not None:
+                docs = pool.apply_async(records_to_docs, (rows,))
+            else:
+                docs = records_to_docs(rows)
+            converting.append((batch, page[-1].identifier, docs))
+
+            while converting and (pool is None or len(converting) > workers):
+                batch, last_identifier, docs = converting.popleft()
+                send_queue.put((batch, last_identifier, docs.get() if pool is not None else docs))
+
+        while converting:
+            batch, last_identifier, docs = converting.popleft()
+            send_queue.put((batch, last_identifier, docs.get() if pool is not None else docs))
+    finally:
+        for thread in threads:
+            send_queue.put(None)
+        for thread in threads:
+            thread.join()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    progress.close()
+    invalidate_search_cache(catalog_slug)
+
+    return progress.indexed, progress.failed
+
+
+def update_aliases(es, actions, attempts=3, delay=1):
+    """Apply alias actions atomically, retrying a failed request with a growing delay.
+    """
+    for attempt in range(attempts):
+        try:
+            return es.post('_aliases', data={'actions': actions})
+        except (ElasticException, requests.exceptions.RequestException) as e:
+            if attempt == attempts - 1:
+                raise
+            LOGGER.warn('Aliases were not updated, retrying: {0}'.format(e))
+            time.sleep(delay * 2 ** attempt)
+
+
+def reindex_catalog(catalog_slug, resume=False):
+    """Rebuild a catalog into a new versioned index and swap the catalog alias to it.
+
+       The new index is loaded with refresh disabled and no replicas, then its
+       settings are restored and it is force merged before the swap, so the
+       catalog keeps serving the previous index until the rebuild is complete.
+       Returns None, leaving the alias unchanged, when documents failed to index.
+    """
+    es, version = es_connect(url=REGISTRY_SEARCH_URL)
+    live_indices = catalog_indices(catalog_slug, es)
+    versions = catalog_versions(catalog_slug, es)
+
+    live_settings = {}
+    if live_indices:
+        live_settings = es.get('{0}/_settings'.format(live_indices[0]))[live_indices[0]]['settings']['index']
+
+    # A resumed rebuild continues loading the newest index not yet aliased.
+    new_version = (versions[-1] if versions else 0) + 1
+    if resume and versions and catalog_index_name(catalog_slug, versions[-1]) not in live_indices:
+        new_version = versions[-1]
+    new_index = catalog_index_name(catalog_slug, new_version)
+
+    if new_version not in versions:
+        load_settings = {'index': {'refresh_interval': '-1', 'number_of_replicas': 0}}
+        create_index(catalog_slug, es, version, index_version=new_version, settings=load_settings, alias=False)
+
+    LOGGER.info('Rebuilding catalog {0} into {1}'.format(catalog_slug, new_index))
+    _, failed = re_index_layers(new_index, resume=resume)
+    if failed:
+        LOGGER.error('{0} documents failed, catalog {1} still uses its previous index'.format(failed, catalog_slug))
+        return None
+
+    es.put('{0}/_settings'.format(new_index), data={
+        'index': {
+            'refresh_interval': live_settings.get('refresh_interval', '1s'),
+            'number_of_replicas': live_settings.get('number_of_replicas', 1),
+        }
+    })
+    major, minor = [int(number) for number in version.split('.')[:2]]
+    merge_endpoint = '_forcemerge' if (major, minor) >= (2, 1) else '_optimize'
+    # Merging blocks until it is done, longer than a search may take.
+    merge_es = es_client(REGISTRY_SEARCH_URL, read_timeout=REGISTRY_REINDEX_MERGE_TIMEOUT or None)['es']
+    try:
+        merge_es.post('{0}/{1}'.format(new_index, merge_endpoint), params={'max_num_segments': 1})
+    except (ElasticException, requests.exceptions.RequestException) as e:
+        # The merge only makes searches faster, the rebuilt index is complete without it.
+        LOGGER.warn('Index {0} was not merged: {1}'.format(new_index, e))
+
+    actions = [{'add': {'index': new_index, 'alias': catalog_slug}}]
+    legacy_index = catalog_slug in live_indices
+    for index in live_indices:
+        if index != catalog_slug:
+            actions.append({'remove': {'index': index, 'alias': catalog_slug}})
+    if legacy_index:
+        # An index named after the catalog must be removed before its name can be an alias,
+        # the catalog is not served until the alias is added.
+        LOGGER.warn('Removing unversioned index {0} before swapping the alias'.format(catalog_slug))
+        es.delete(catalog_slug)
+    try:
+        update_aliases(es, actions)
+    except (ElasticException, requests.exceptions.RequestException):
+        LOGGER.error('Catalog {0} was rebuilt into {1} but its alias was not swapped, post {2} to '
+                     '_aliases to serve it'.format(catalog_slug, new_index, json.dumps({'actions': actions})))
+        raise
+    invalidate_catalogs()
+    invalidate_search_cache(catalog_slug)
+
+    for index in live_indices:
+        if index != catalog_slug:
+            es.delete(index)
+
+    return new_index
+
+
+def check_interval(checks_list, reliability_rate):
+    """Return the seconds between checks of a layer, shorter the less reliable it is.
+    """
+    min_interval, max_interval = REGISTRY_CHECK_MIN_INTERVAL * 3600, REGISTRY_CHECK_MAX_INTERVAL * 3600
+    # A layer failing or with a malformed last check is checked again as soon as possible.
+    if not checks_list or not isinstance(checks_list[-1], dict) or list(checks_list[-1].values()).count('1') > 0:
+        return min_interval
+
+    return min_interval + (max_interval - min_interval) * (float(reliability_rate or 0) / 100) ** 2
+
+
+def check_times(checks_list):
+    """Return the unix timestamps of the checks of a layer, skipping the malformed ones.
+    """
+    times = []
+    for check in checks_list:
+        try:
+            times.append(time.mktime(time.strptime(check['timestamp'], '%Y-%m-%d %H:%M:%S')))
+        except (KeyError, TypeError, ValueError):
+            LOGGER.warn('Check {0} has no valid timestamp'.format(check))
+
+    return times
+
+
+def check_priority(checks_list, reliability_rate, now, times=None):
+    """Return how overdue the next check of a layer is, as the elapsed time over its check
+       interval, or None when the layer is not due. Layers never checked come first.
+    """
+    times = check_times(checks_list) if times is None else times
+    if not times:
+        return float('inf')
+
+    priority = (now - times[-1]) / check_interval(checks_list, reliability_rate)
+    if priority < 1:
+        return None
+
+    return priority
+
+
+def schedule_checks(es, catalog=None, budget=REGISTRY_CHECK_NETLOC_BUDGET, now=None):
+    """Return the uuids of the layers due for a check, most overdue first. Each remote
+       server gets the checks left of its daily budget, counted from the checks_list of
+       its layers, so upstream requests go to the layers that need them most.
+    """
+    now = now or time.time()
+    catalogs = [catalog] if catalog else list_catalogs(es)
+    if not catalogs:
+        return []
+
+    query = {
+        "_source": ["layer_identifier", "checks_list", "reliability_rate", "source_host"],
+        "query": {"match_all": {}}
+    }
+    # Most overdue layers of each server, at most budget of them.
+    candidates = collections.defaultdict(list)
+    # Layers are copied in every catalog holding them, each one is counted once.
+    seen = set()
+    recent = collections.Counter()
+    for hit in scroll_documents(es, ','.join(catalogs), query):
+        layer_dic = hit['_source']
+        uuid, netloc = layer_dic.get('layer_identifier'), layer_dic.get('source_host', '')
+        checks_list = layer_dic.get('checks_list') or []
+        if not uuid or uuid in seen:
+            continue
+        seen.add(uuid)
+        times = check_times(checks_list)
+        recent[netloc] += sum(1 for checked in times if now - checked < 86400)
+        priority = check_priority(checks_list, layer_dic.get('reliability_rate'), now, times)
+        if priority is None:
+            continue
+
+        heap = candidates[netloc]
+        if len(heap) < budget:
+            heapq.heappush(heap, (priority, uuid))
+        elif priority > heap[0][0]:
+            heapq.heapreplace(heap, (priority, uuid))
+
+    scheduled = []
+    for netloc, heap in candidates.items():
+        left = max(0, budget - recent[netloc])
+        scheduled.extend(heapq.nlargest(left, heap))
+        LOGGER.debug('{0} layers of {1} scheduled, {2} checked in the last day'.format(
+            min(left, len(heap)), netloc, recent[netloc]))
+
+    return [uuid for _, uuid in sorted(scheduled, reverse=True)]
+
+
+def scroll_documents(es, index, query, size=REGISTRY_CSW_MAX_RECORDS, scroll='5m'):
+    """Yield every hit matching query in index using the scroll api.
+    """
+    query = dict(query, size=size)
+    response = es.post('{0}/_search'.format(index), params={'scroll': scroll}, data=query)
+    while response['hits']['hits']:
+        for hit in response['hits']['hits']:
+            yield hit
+        response = es.post('_search/scroll', params={'scroll': scroll}, data=response['_scroll_id'])
+
+
+def migrate_documents(es, catalog_slug, hits):
+    """Index hits under their layer uuid, then delete the old ids of the ones indexed.
+       Returns the number of documents migrated and failed.
+    """
+    index_actions = [(bulk_action('index', catalog_slug, hit['_source']['layer_identifier']), hit['_source'])
+                     for hit in hits]
+    not_indexed = set()
+    for action, doc, error in bulk_index(es, index_actions):
+        not_indexed.add(action['index']['_id'])
+        LOGGER.error('Layer {0} was not migrated: {1}'.format(action['index']['_id'], error))
+
+    # An old document is only removed once its copy is indexed, a failed delete leaves both.
+    delete_actions = [(bulk_action('delete', catalog_slug, hit['_id']), None)
+                      for hit in hits if hit['_source']['layer_identifier'] not in not_indexed]
+    failed_deletes = bulk_index(es, delete_actions) if delete_actions else []
+    for action, doc, error in failed_deletes:
+        LOGGER.error('Document {0} was migrated but not removed: {1}'.format(action['delete']['_id'], error))
+
+    failed = len(not_indexed) + len(failed_deletes)
+    return len(hits) - failed, failed
+
+
+def migrate_index_ids(catalog_slug, es=None):
+    """Re-index documents of a catalog using the layer uuid as document id.
+       Returns the number of documents migrated and failed.
+    """
+    if es is None:
+        es, _ = es_connect(url=REGISTRY_SEARCH_URL)
+    hits, migrated, failed = [], 0, 0
+    for hit in scroll_documents(es, catalog_slug, {"query": {"match_all": {}}}):
+        uuid = hit['_source'].get('layer_identifier')
+        if not uuid or hit['_id'] == uuid:
+            continue
+        hits.append(hit)
+        if len(hits) >= REGISTRY_INDEX_BATCH_SIZE:
+            batch_migrated, batch_failed = migrate_documents(es, catalog_slug, hits)
+            migrated, failed, hits = migrated + batch_migrated, failed + batch_failed, []
+
+    if hits:
+        batch_migrated, batch_failed = migrate_documents(es, catalog_slug, hits)
+        migrated, failed = migrated + batch_migrated, failed + batch_failed
+    invalidate_search_cache(catalog_slug)
+    LOGGER.debug('{0} documents of catalog {1} migrated, {2} failed'.format(migrated, catalog_slug, failed))
+
+    return migrated, failed
 
 
 urlpatterns = [
@@ -1910,6 +4406,10 @@ urlpatterns = [
     url(r'^catalog$', list_catalogs_view),
     url(r'^catalog/(?P<catalog>\w+)/csw$', csw_view),
     url(r'^catalog/(?P<catalog>\w+)/api/$', search_view),
+    url(r'^api/msearch$', msearch_view),
+    url(r'^catalog/(?P<catalog>\w+)/api/msearch$', msearch_view),
+    url(r'^api/export\.(?P<export_format>ndjson|geojson|csv)$', export_view),
+    url(r'^catalog/(?P<catalog>\w+)/api/export\.(?P<export_format>ndjson|geojson|csv)$', export_view),
     url(r'^layer/(?P<layer_uuid>[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}).js$', layer_json_view, name="layer_json"),
     url(r'^layer/(?P<layer_uuid>[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}).yml$', layer_yml_view, name="layer_yml"),
     url(r'^layer/(?P<layer_uuid>[\w]{8}-[\w]{4}-[\w]{4}-[\w]{4}-[\w]{12}).png$', layer_png_view, name="layer_png"),
@@ -1925,39 +4425,52 @@ if __name__ == '__main__':  # pragma: no cover
 
     if 'reliability' in sys.argv[:2]:
         es, _ = es_connect(url=REGISTRY_SEARCH_URL)
-        for line in sys.stdin:
-            uuid, reliability_dic = parse_values_from_string(line)
-            layer_dic, layer_id, index_name = get_data_from_es(es, uuid)
-            layer_dic['checks_list'] = add_dict_to_list(layer_dic['checks_list'], reliability_dic)
-            layer_dic['reliability_rate'] = compute_reliability(layer_dic['checks_list'])
+        updated, failed = update_reliability(es, sys.stdin)
+        for action, doc, error in failed:
+            LOGGER.error('Layer {0} was not updated: {1}'.format(action['update']['_id'], error))
+        LOGGER.debug('{0} layers updated with reliability'.format(updated))
+        sys.exit(1 if failed else 0)
 
-            es.put('{0}/layer/{1}'.format(index_name, layer_id), data=layer_dic)
-            LOGGER.debug('Layer {0} updated with reliablity {1}%\n'.format(uuid, layer_dic['reliability_rate']))
+    if 'schedule_checks' in sys.argv[:2]:
+        es, _ = es_connect(url=REGISTRY_SEARCH_URL)
+        for uuid in schedule_checks(es, catalog=sys.argv[2] if len(sys.argv) > 2 else None):
+            sys.stdout.write('{0}\n'.format(uuid))
+        sys.exit(0)
+
+    if 'render_thumbnails' in sys.argv[:2]:
+        if len(sys.argv) < 3:
+            LOGGER.error('Undefined catalog slug in command line input')
+            sys.exit(1)
+        render_thumbnails(sys.argv[2])
+        sys.exit(0)
 
+    if 'prune_tile_cache' in sys.argv[:2]:
+        prune_tile_cache()
         sys.exit(0)
 
     if 'check_layers' in sys.argv[:2]:
-        netlocs_dic = {}
-        for line in sys.stdin:
-            uuid = line.rstrip()
-            valid_bbox, valid_config, valid_image, check_color = check_layer(uuid)
-            output = '%s %s %s %s %s %d\n' % (uuid,
-                                              valid_bbox,
-                                              valid_config,
-                                              valid_image,
-                                              check_color,
-                                              int(time.time()))
-            LOGGER.debug(output)
+        archive = ConfigArchive(REGISTRY_CHECK_ARCHIVE) if REGISTRY_CHECK_ARCHIVE else None
+        try:
+            for result in check_layers((line for line in sys.stdin if line.strip()), archive=archive):
+                output = '%s %s %s %s %s %d\n' % result
+                LOGGER.debug(output)
+                sys.stdout.write(output)
+                sys.stdout.flush()
+        finally:
+            if archive is not None:
+                archive.close()
         sys.exit(0)
 
     if 'pycsw' in sys.argv[:2]:
 
         OPTS, ARGS = getopt.getopt(sys.argv[2:], 'c:f:ho:p:ru:x:s:t:y')
 
-        xml_dirpath, catalog_slug = None, None
+        xml_dirpath, catalog_slug, resume = None, None, False
         for o, a in OPTS:
             if o == '-c':
                 COMMAND = a
+            elif o == '-r':
+                resume = True
             elif o == '-p':
                 xml_dirpath = a
             elif o == '-s':
@@ -1974,7 +4487,8 @@ if __name__ == '__main__':  # pragma: no cover
                               'delete_records',
                               'list_layers',
                               'optimize_db',
-                              'reindex']
+                              'reindex',
+                              'migrate_ids']
 
         if COMMAND not in available_commands:
             LOGGER.error('pycsw supports only the following commands: %s' % available_commands)
@@ -1991,9 +4505,16 @@ if __name__ == '__main__':  # pragma: no cover
             if not catalog_slug:
                 LOGGER.error('Undefined catalog slug in command line input')
                 sys.exit(1)
-            if not check_index_exists(catalog_slug):
-                create_index(catalog_slug)
-            re_index_layers(catalog_slug)
+            if reindex_catalog(catalog_slug, resume=resume) is None:
+                sys.exit(1)
+
+        elif COMMAND == 'migrate_ids':
+            if not catalog_slug:
+                LOGGER.error('Undefined catalog slug in command line input')
+                sys.exit(1)
+            _, failed = migrate_index_ids(catalog_slug)
+            if failed:
+                sys.exit(1)
 
         elif COMMAND == 'get_sysprof':
             LOGGER.debug(pycsw_admin.get_sysprof())
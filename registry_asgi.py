@@ -0,0 +1,288 @@
+"""ASGI application of registry for python 3.5 or later.
+
+Searches and the list of catalogs are answered without blocking, using a
+pooled aiohttp client to talk to Elasticsearch, so a single worker can have
+many searches in flight. Every other request, such as CSW-T and the layer
+endpoints served by MapProxy, runs the registry Django application in a pool
+of threads and is streamed back to the client.
+
+    pip install aiohttp uvicorn
+    uvicorn registry_asgi:application
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import aiohttp
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'registry')
+
+import registry  # noqa
+from django.core.wsgi import get_wsgi_application  # noqa
+
+REGISTRY_ASYNC_POOL_SIZE = int(os.getenv('REGISTRY_ASYNC_POOL_SIZE', '100'))
+REGISTRY_ASYNC_THREADS = int(os.getenv('REGISTRY_ASYNC_THREADS', '20'))
+
+SEARCH_PATHS = [re.compile(r'^/api$'), re.compile(r'^/catalog/(?P<catalog>\w+)/api/$')]
+CATALOGS_PATH = re.compile(r'^/catalog$')
+
+SESSIONS = {}
+VERSION = {'number': None, 'checked': 0}
+EXECUTOR = ThreadPoolExecutor(max_workers=REGISTRY_ASYNC_THREADS)
+WSGI_APPLICATION = get_wsgi_application()
+
+
+def get_session():
+    """Return the client session of the running loop, creating it on first use.
+    """
+    loop = asyncio.get_event_loop()
+    session = SESSIONS.get(loop)
+    if session is None or session.closed:
+        auth = None
+        if registry.REGISTRY_SEARCH_USERNAME is not None and registry.REGISTRY_SEARCH_PASSWORD is not None:
+            auth = aiohttp.BasicAuth(registry.REGISTRY_SEARCH_USERNAME, registry.REGISTRY_SEARCH_PASSWORD)
+        timeout = aiohttp.ClientTimeout(connect=registry.REGISTRY_SEARCH_CONNECT_TIMEOUT,
+                                        sock_read=registry.REGISTRY_SEARCH_READ_TIMEOUT)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=REGISTRY_ASYNC_POOL_SIZE),
+                                        auth=auth, timeout=timeout)
+        SESSIONS[loop] = session
+
+    return session
+
+
+async def close_session():
+    session = SESSIONS.pop(asyncio.get_event_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def es_request(method, path, data=None, params=None):
+    """Send a request to Elasticsearch and return the text of its response.
+       Raises ElasticException for error responses, as the rawes client does.
+    """
+    url = path
+    if not path.startswith('http'):
+        url = '{0}/{1}'.format(registry.REGISTRY_SEARCH_URL.rstrip('/'), path)
+    if isinstance(data, dict):
+        data = json.dumps(data)
+
+    async with get_session().request(method, url, data=data, params=params) as response:
+        text = await response.text()
+    if response.status >= 400:
+        raise registry.ElasticException(message='ElasticSearch Error: {0}'.format(text),
+                                        result=text, status_code=response.status)
+
+    return text
+
+
+async def es_version():
+    """Return the major version of Elasticsearch, requested again when the cached value expires.
+    """
+    now = time.time()
+    if VERSION['number'] is None or now - VERSION['checked'] > registry.REGISTRY_SEARCH_VERSION_TTL:
+        info = registry.JSON_LOADS(await es_request('get', ''))
+        VERSION.update(number=int(info['version']['number'][0]), checked=now)
+
+    return VERSION['number']
+
+
+async def list_catalogs(refresh=False):
+    """Return the list of catalogs, sharing the catalog cache of the registry module.
+    """
+    with registry.CATALOG_CACHE_LOCK:
+        cached = registry.CATALOG_CACHE.get(registry.REGISTRY_SEARCH_URL)
+    now = time.time()
+    if not refresh and cached is not None and now - cached['updated'] <= registry.REGISTRY_CATALOG_CACHE_TTL:
+        return cached['catalogs']
+
+    catalogs = registry.catalogs_from_aliases(registry.JSON_LOADS(await es_request('get', '_aliases')))
+    with registry.CATALOG_CACHE_LOCK:
+        registry.CATALOG_CACHE[registry.REGISTRY_SEARCH_URL] = {'catalogs': catalogs, 'updated': now}
+
+    return catalogs
+
+
+async def search(serializer, catalog):
+    """Asynchronous registry.elasticsearch(). Heatmap tiles and facet rollups are
+       only used by the synchronous search.
+    """
+    version = await es_version()
+    if catalog and serializer.validated_data.get('search_engine_endpoint') is None:
+        # The catalog may have been created by another process since the last refresh.
+        missing = catalog not in await list_catalogs()
+        if missing and not registry.catalog_recently_missing(catalog):
+            missing = catalog not in await list_catalogs(refresh=True)
+            if missing:
+                registry.remember_missing_catalog(catalog)
+        if missing:
+            return 404, {"error": {"msg": "Catalog {0} does not exist".format(catalog)}}
+
+    try:
+        search_engine_endpoint, dic_query = registry.compile_search(serializer, catalog, None, version,
+                                                                    check_catalog=False)
+    except registry.SearchError as e:
+        return e.status, e.error
+
+    endpoint, body, params = registry.search_request(serializer, search_engine_endpoint, dic_query, version)
+    try:
+        text = await es_request('post', endpoint, body, params or None)
+    except registry.ElasticException as e:
+        return e.status_code, {"error": {"msg": str(e.args)}}
+    except aiohttp.ClientError as e:
+        return 400, {"error": {"msg": str(e)}}
+
+    if serializer.validated_data.get('original_response') and serializer.validated_data.get('d_docs_cursor') is None:
+        return registry.RawJSON(text)
+
+    return registry.shape_search(serializer, search_engine_endpoint, dic_query, registry.JSON_LOADS(text))
+
+
+async def search_view(scope, send, catalog=None):
+    params = dict((key.replace('.', '_'), value)
+                  for key, value in parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+    serializer = registry.SearchSerializer(data=params)
+    if not serializer.is_valid():
+        await respond(send, 400, json.dumps(serializer.errors))
+        return
+
+    cache = registry.get_search_cache()
+    if cache is None or 'scroll' in (serializer.validated_data.get('d_docs_cursor') or {}):
+        data = registry.json_dumps(await search(serializer, catalog))
+    else:
+        key = registry.search_cache_key(serializer.validated_data, catalog, cache.generation(catalog or '*'))
+        data = cache.get(key)
+        if data is None:
+            result = await search(serializer, catalog)
+            data = registry.json_dumps(result)
+            if not isinstance(result, tuple):
+                cache.set(key, data)
+
+    await respond(send, 200, data)
+
+
+async def list_catalogs_view(scope, send):
+    catalogs = await list_catalogs()
+    if len(catalogs) == 0:
+        await respond(send, 404, 'Empty list of catalogs')
+        return
+
+    response_list = [registry.create_response_dict(i, catalog) for i, catalog in enumerate(catalogs)]
+    await respond(send, 200, registry.json_dumps(response_list))
+
+
+async def respond(send, status, body, content_type='application/json'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1'))],
+    })
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+
+def wsgi_environ(scope, body):
+    """Return the WSGI environ of an ASGI http request.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+
+    return environ
+
+
+def start_wsgi(environ):
+    """Run the registry Django application and return its status, headers and body iterator.
+    """
+    captured = []
+
+    def start_response(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+
+    app_iter = WSGI_APPLICATION(environ, start_response)
+
+    return int(captured[0].split(' ')[0]), captured[1], app_iter
+
+
+async def wsgi_view(scope, receive, send):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    loop = asyncio.get_event_loop()
+    status, headers, app_iter = await loop.run_in_executor(EXECUTOR, start_wsgi, wsgi_environ(scope, body))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    # Chunks are read in the thread pool, so streaming responses keep streaming.
+    chunks = iter(app_iter)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(EXECUTOR, next, chunks, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if hasattr(app_iter, 'close'):
+            await loop.run_in_executor(EXECUTOR, app_iter.close)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_session()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    path = scope['path']
+    if scope['method'] == 'GET':
+        for pattern in SEARCH_PATHS:
+            matcher = pattern.match(path)
+            if matcher:
+                await search_view(scope, send, **matcher.groupdict())
+                return
+        if CATALOGS_PATH.match(path):
+            await list_catalogs_view(scope, send)
+            return
+
+    await wsgi_view(scope, receive, send)
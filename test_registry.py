@@ -6,7 +6,11 @@ import rawes
 import registry
 import requests
 import shutil
+import sys
+import time
 import yaml
+import zipfile
+import zlib
 from datetime import datetime
 from django.test import RequestFactory
 from PIL import Image
@@ -348,6 +352,22 @@ def test_create_transaction(client):
     assert 'layer_1 titleterm1' == layer_dic['title']
     assert 'test' == index_name
 
+    # Checks are applied in batches with partial updates.
+    lines = ['{0} 0 0 0 0 1483721501\n'.format(layer_uuid), '{0} 0 0 0 1 1483721502\n'.format(layer_uuid),
+             '\n', 'missing-uuid 0 0 0 0 1483721503\n']
+    updated, failed = registry.update_reliability(es_client, lines, batch_size=2)
+    assert (1, []) == (updated, failed)
+    es_client.post('/_refresh')
+    layer_dic, _, _ = registry.get_data_from_es(es_client, layer_uuid)
+    assert 'layer_1 titleterm1' == layer_dic['title']
+    assert ['0', '1'] == [check['check_color'] for check in layer_dic['checks_list']]
+    assert 50.0 == layer_dic['reliability_rate']
+
+    # Layers never checked are scheduled before the ones with checks.
+    scheduled = registry.schedule_checks(es_client, catalog=catalog_slug)
+    assert layer_uuid == scheduled[-1]
+    assert len(layers_list) - 1 == len(set(scheduled)) == len(scheduled)
+
 
 def test_parse_params(client):
     params_test = {
@@ -366,6 +386,114 @@ def test_parse_params(client):
     assert False in assert_dots
 
 
+def test_json_codec():
+    dumps, loads = registry.load_json_codec('json')
+    assert (json.dumps, json.loads) == (dumps, loads)
+
+    # Every codec reads what the others write.
+    dumps, loads = registry.load_json_codec('auto')
+    data = {'a.matchDocs': 1, 'd.docs': [{'title': u'caf\xe9', 'links': 'layer/1/png'}], 'counts': [[0, 1], None]}
+    assert data == json.loads(dumps(data)) == loads(json.dumps(data))
+
+    # Raw responses are sent as they were received.
+    raw = registry.RawJSON('{"hits": {"total": 1}}')
+    assert '{"hits": {"total": 1}}' == registry.json_dumps(raw)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='The ASGI application needs python 3.5')
+def test_asgi_search(client):
+    pytest.importorskip('aiohttp')
+    asyncio = pytest.importorskip('asyncio')
+    registry_asgi = pytest.importorskip('registry_asgi')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def call(path, query_string=b''):
+        messages = []
+
+        def receive():
+            future = loop.create_future()
+            future.set_result({'type': 'http.request', 'body': b'', 'more_body': False})
+            return future
+
+        def send(message):
+            messages.append(message)
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': []}
+        loop.run_until_complete(registry_asgi.application(scope, receive, send))
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    try:
+        # Searches answer the same as the synchronous view.
+        status, body = call(catalog_search_api, b'd.docs.limit=100')
+        expected = json.loads(client.get(catalog_search_api, {'d_docs_limit': 100}).content.decode('utf-8'))
+        assert 200 == status
+        assert expected['d.docs'] == json.loads(body.decode('utf-8'))['d.docs']
+
+        status, body = call('/catalog/wrong_index/api/')
+        assert 404 == json.loads(body.decode('utf-8'))[0]
+
+        status, body = call('/catalog')
+        assert catalog_slug in [catalog['slug'] for catalog in json.loads(body.decode('utf-8'))]
+
+        # Other endpoints are served by the Django application.
+        status, body = call('/layer/f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170.yml')
+        assert 200 == status
+        assert b'layers' in body
+    finally:
+        loop.run_until_complete(registry_asgi.close_session())
+        loop.close()
+
+
+def test_msearch_api(client):
+    msearch_api = '/catalog/{0}/api/msearch'.format(catalog_slug)
+    time_params = dict(default_params, a_time_gap='P1Y', a_time_limit=1)
+    params_list = [default_params, dict(default_params, d_docs_limit=2), time_params, {'d.docs.page': -1}]
+
+    response = client.post(msearch_api, json.dumps(params_list), content_type='application/json')
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    assert len(params_list) == len(results)
+
+    # Batched searches answer like the search api.
+    for params, result in zip(params_list[:3], results):
+        single = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))
+        assert single['a.matchDocs'] == result['a.matchDocs']
+        assert single['d.docs'] == result['d.docs']
+    assert 'a.time' in results[2]
+    assert 400 == results[3][0]
+
+    response = client.post(msearch_api, json.dumps({'q.text': 'water'}), content_type='application/json')
+    assert 400 == response.status_code
+
+
+def test_export_api(client):
+    export_api = '/catalog/{0}/api/export.'.format(catalog_slug)
+    params = default_params.copy()
+
+    response = client.get(export_api + 'ndjson', params)
+    assert 200 == response.status_code
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert len(layers_list) - 1 == len(lines)
+    assert all('layer_identifier' in json.loads(line) for line in lines)
+
+    response = client.get(export_api + 'geojson', params)
+    collection = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+    assert 'FeatureCollection' == collection['type']
+    assert len(layers_list) - 1 == len(collection['features'])
+
+    response = client.get(export_api + 'csv', params, HTTP_ACCEPT_ENCODING='gzip')
+    assert 'gzip' == response['Content-Encoding']
+    content = zlib.decompress(b''.join(response.streaming_content), 16 + zlib.MAX_WBITS)
+    assert len(layers_list) == len(content.decode('utf-8').splitlines())
+
+    response = client.get('/catalog/wrong_index/api/export.csv', params)
+    assert 404 == response.status_code
+
+
 def test_search_api(client):
     # Test configuration file for swagger api client.
     response = client.get('/api/config')
@@ -406,6 +534,38 @@ def test_search_api(client):
         first_year, second_year = item[0], item[1]
         assert first_year >= second_year
 
+    # Cursor pagination returns every document once, page by page.
+    params = default_params.copy()
+    params['d_docs_limit'] = 2
+    params['d_docs_cursor'] = '*'
+    identifiers = []
+    while params['d_docs_cursor']:
+        response = client.get(catalog_search_api, params)
+        assert 200 == response.status_code
+        results = json.loads(response.content.decode('utf-8'))
+        identifiers.extend(doc['layer_identifier'] for doc in results['d.docs'])
+        params['d_docs_cursor'] = results['d.docs.cursor']
+    assert len(layers_list) - 1 == len(set(identifiers)) == len(identifiers)
+
+    params['d_docs_cursor'] = 'not a cursor'
+    response = client.get(catalog_search_api, params)
+    assert 400 == response.status_code
+
+    # Source filtering with profiles and lists of fields.
+    params = default_params.copy()
+    params['d_docs_limit'] = 100
+    params['d_docs_fields'] = 'minimal'
+    results = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))
+    assert all(set(doc) <= {'layer_identifier', 'title', 'layer_date', 'bbox'} for doc in results['d.docs'])
+
+    params['d_docs_fields'] = 'title,-abstract'
+    results = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))
+    assert all(list(doc) == ['title'] for doc in results['d.docs'])
+
+    params['d_docs_fields'] = ','
+    response = client.get(catalog_search_api, params)
+    assert 400 == response.status_code
+
     # Test 404 error giving wrong search index.
     params = default_params.copy()
     wrong_search_endpoint = '/catalog/{0}/api/'.format('wrong_index')
@@ -500,6 +660,112 @@ def test_heatmap(client):
     assert 5 == results['a.matchDocs']
     assert results['a.hm']['gridLevel'] == 5
 
+    # Heatmaps stitched from cached tiles match the ones computed at once.
+    registry.HEATMAP_TILES.clear()
+    tiled = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))['a.hm']
+    cached = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))['a.hm']
+    assert registry.HEATMAP_TILES.stats()['hits'] > 0
+    registry.REGISTRY_HEATMAP_CACHE_SIZE = 0
+    try:
+        untiled = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))['a.hm']
+    finally:
+        registry.REGISTRY_HEATMAP_CACHE_SIZE = 2000
+    assert tiled == cached
+    assert tiled['counts_ints2D'] == untiled['counts_ints2D']
+
+    # Layers extending past the viewport are counted the same with and without tiles.
+    params['a_hm_filter'] = '[-30,-30 TO 0,0]'
+    registry.HEATMAP_TILES.clear()
+    tiled = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))['a.hm']
+    registry.REGISTRY_HEATMAP_CACHE_SIZE = 0
+    try:
+        untiled = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))['a.hm']
+    finally:
+        registry.REGISTRY_HEATMAP_CACHE_SIZE = 2000
+    assert tiled['counts_ints2D'] == untiled['counts_ints2D']
+    assert any(any(row or []) for row in tiled['counts_ints2D'] or [])
+
+
+def test_facet_rollups(client):
+    params = default_params.copy()
+    params['a_categories_limit'] = 10
+    params_list = [
+        dict(params, a_time_gap='P1Y'),
+        dict(params, a_time_gap='P7D', q_time='[2000-01-01 TO *]'),
+        dict(params, a_time_gap='PT24H', q_time='[2001-01-01 TO *]'),
+        dict(params, a_time_gap='P1W', q_text='vehicula'),
+    ]
+    for params in params_list:
+        registry.REGISTRY_ROLLUPS = False
+        expected = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))
+        registry.REGISTRY_ROLLUPS = True
+        try:
+            results = json.loads(client.get(catalog_search_api, params).content.decode('utf-8'))
+        finally:
+            registry.REGISTRY_ROLLUPS = False
+        assert expected['a.time'] == results['a.time']
+        assert expected['a.categories'] == results['a.categories']
+        assert expected['a.matchDocs'] == results['a.matchDocs']
+    assert catalog_slug in registry.ROLLUPS
+
+    # Searches filtered by other fields still use aggregations.
+    assert 'q_text' in registry.ROLLUP_FILTERS
+    assert registry.rollup_bucket(0, '1m') is None
+    with pytest.raises(ValueError):
+        registry.rollup_first_day('[2000-01-01T00:00:00Z TO 2001-01-01T00:00:00Z]')
+
+
+def test_rollup_rebuild():
+    built = []
+    settings = registry.build_rollup, registry.REGISTRY_ROLLUP_REBUILD_INTERVAL
+    registry.build_rollup = lambda es, catalog: built.append(catalog) or {'days': {}, 'categories': {}}
+    registry.REGISTRY_ROLLUP_REBUILD_INTERVAL = 0
+    try:
+        rollup = registry.get_rollup(None, 'rollup_test')
+        assert rollup is registry.get_rollup(None, 'rollup_test')
+        assert 1 == len(built)
+
+        # The previous rollup is served while a write rebuilds it in the background.
+        registry.invalidate_search_cache('rollup_test')
+        assert rollup is registry.get_rollup(None, 'rollup_test')
+        for _ in range(100):
+            if registry.ROLLUPS['rollup_test'] is not rollup:
+                break
+            time.sleep(0.01)
+        assert 2 == len(built)
+        assert registry.ROLLUPS['rollup_test'] is registry.get_rollup(None, 'rollup_test')
+    finally:
+        registry.build_rollup, registry.REGISTRY_ROLLUP_REBUILD_INTERVAL = settings
+        registry.ROLLUPS.pop('rollup_test', None)
+
+
+def test_heatmap_tiles():
+    # Boxes grow to the cells of the grid level.
+    assert (0.0, 0.0, 33.75, 33.75) == registry.snap_heatmap_box((0, 0, 30, 30), 5)
+    assert (16, 16, 19, 22) == registry.heatmap_cells(registry.snap_heatmap_box((0.1, 0.2, 30, 30), 5), 5)
+
+    viewport = {'min_x': 0.0, 'max_y': 33.75, 'counts': [[1, 0], None, [0, 2]]}
+    cells = registry.heatmap_response_cells(viewport, 5)
+    assert {(16, 21): 1, (17, 19): 2} == cells
+
+    heatmap = registry.stitch_heatmap(cells, (16, 19, 18, 22), 5)
+    assert [[1, 0], None, [0, 2]] == heatmap['counts']
+    assert (2, 3) == (heatmap['columns'], heatmap['rows'])
+    assert (0.0, 16.875) == (heatmap['min_x'], heatmap['min_y'])
+
+    # Layers crossing the border of a tile are counted in its cells, as in heatmaps computed at once.
+    query = registry.heatmap_tile_query({'match_all': {}}, {'field': 'layer_geoshape'}, 5, (0, 0))
+    assert 'intersects' == query['aggs']['viewport']['heatmap']['geom']['geo_shape']['layer_geoshape']['relation']
+    serializer = registry.SearchSerializer(data=dict(default_params, a_hm_limit=1, a_hm_gridlevel=5))
+    assert serializer.is_valid()
+    untiled = registry.compile_search(serializer, None, None, 5, check_catalog=False)[1]
+    assert 'intersects' == untiled['aggs']['viewport']['heatmap']['geom']['geo_shape']['layer_geoshape']['relation']
+
+    # Tiles are keyed by a generation that changes on writes.
+    generation = registry.search_generation('heatmap_test')
+    registry.invalidate_search_cache('heatmap_test')
+    assert generation != registry.search_generation('heatmap_test')
+
 
 def test_q_text_keywords(client):
     params = default_params.copy()
@@ -851,6 +1117,140 @@ def test_mapproxy(client):
     assert 200 == response.status_code
 
 
+def test_layer_repository():
+    repository = registry.get_repository()
+    assert repository is registry.get_repository()
+
+    layer_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170'
+    layer = registry.layer_from_csw(layer_uuid)
+    assert layer_uuid == layer.identifier
+    assert registry.layer_from_csw('f28ad41b-b91f-4d5d-a7c3-4b17dfaa5171') is None
+
+
+def test_thumbnail_cache(client):
+    layer_uuid = '0cbd4894-c9d2-4624-b4fc-ea66d2d1c71c'
+    layer = registry.layer_from_csw(layer_uuid)
+    path = registry.thumbnail_path(layer)
+    if os.path.exists(path):
+        os.remove(path)
+
+    response = client.get('/layer/{0}.png'.format(layer_uuid))
+    assert 200 == response.status_code
+    assert os.path.exists(path)
+    etag = response['ETag']
+
+    response = client.get('/layer/{0}.png'.format(layer_uuid), HTTP_IF_NONE_MATCH=etag)
+    assert 304 == response.status_code
+
+    response = client.get('/layer/{0}.png'.format(layer_uuid), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+    assert 304 == response.status_code
+
+    # Lists of tags, weak tags and * are compared weakly.
+    for if_none_match in ['"other", {0}'.format(etag), 'W/{0}'.format(etag), '*']:
+        response = client.get('/layer/{0}.png'.format(layer_uuid), HTTP_IF_NONE_MATCH=if_none_match)
+        assert 304 == response.status_code
+
+    response = client.get('/layer/{0}.png'.format(layer_uuid), HTTP_IF_NONE_MATCH='"other"')
+    assert 200 == response.status_code
+    assert 'image/png' in response.serialize_headers().decode('utf-8')
+
+
+def test_store_thumbnail(tmpdir):
+    layer_uuid = '0cbd4894-c9d2-4624-b4fc-ea66d2d1c71c'
+    old_path = str(tmpdir.join('{0}-old.png'.format(layer_uuid)))
+    gone_path = str(tmpdir.join('{0}-gone.png'.format(layer_uuid)))
+    path = str(tmpdir.join('{0}-new.png'.format(layer_uuid)))
+    with open(old_path, 'wb') as f:
+        f.write(b'old')
+
+    # A version removed by a concurrent render is skipped.
+    real_glob = registry.glob.glob
+    registry.glob.glob = lambda pattern: real_glob(pattern) + [gone_path]
+    try:
+        registry.store_thumbnail(path, b'new')
+    finally:
+        registry.glob.glob = real_glob
+    assert not os.path.exists(old_path)
+    with open(path, 'rb') as f:
+        assert b'new' == f.read()
+
+
+def test_mapproxy_cache(client):
+    layer_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170'
+    registry.MAPPROXY_APPS.clear()
+    before = registry.MAPPROXY_APPS.stats()
+
+    response = client.get('/layer/{0}.yml'.format(layer_uuid))
+    assert 200 == response.status_code
+    response = client.get('/layer/{0}.js'.format(layer_uuid))
+    assert 200 == response.status_code
+
+    stats = registry.MAPPROXY_APPS.stats()
+    assert 1 == stats['size']
+    assert before['misses'] + 1 == stats['misses']
+    assert before['hits'] + 1 == stats['hits']
+
+    registry.invalidate_layer(layer_uuid)
+    assert 0 == registry.MAPPROXY_APPS.stats()['size']
+
+    cache = registry.LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert 1 == cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert 1 == cache.get('a')
+    assert 1 == cache.stats()['evictions']
+
+    # Entries are evicted by their summed weight.
+    cache = registry.LRUCache(maxsize=10, maxweight=5, weigh=len)
+    cache.set('a', 'xx')
+    cache.set('b', 'xx')
+    assert 4 == cache.stats()['weight']
+    cache.set('c', 'xx')
+    assert cache.get('a') is None
+    assert 'xx' == cache.get('c')
+    assert 4 == cache.stats()['weight']
+    cache.invalidate(lambda key: key == 'b')
+    assert 2 == cache.stats()['weight']
+    assert registry.estimate_size({'a': ['b' * 100]}) > 100
+
+
+def test_tile_cache_prune(tmpdir):
+    settings = (registry.MAPPROXY_CACHE_DIR, registry.REGISTRY_MAPPROXY_CACHE_TYPE,
+                registry.REGISTRY_MAPPROXY_CACHE_TTL, registry.REGISTRY_MAPPROXY_CACHE_QUOTA_MB)
+    registry.MAPPROXY_CACHE_DIR = str(tmpdir)
+    registry.REGISTRY_MAPPROXY_CACHE_TYPE = 'file'
+    try:
+        old_layer, new_layer = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170', '0cbd4894-c9d2-4624-b4fc-ea66d2d1c71c'
+        for layer_uuid in (old_layer, new_layer):
+            registry.touch_layer_cache(layer_uuid, interval=0)
+            tiles_dir = os.path.join(registry.layer_tile_cache(layer_uuid)['directory'], '01')
+            os.makedirs(tiles_dir)
+            with open(os.path.join(tiles_dir, 'fresh.png'), 'wb') as f:
+                f.write(b'0' * 1024 * 1024)
+            with open(os.path.join(tiles_dir, 'stale.png'), 'wb') as f:
+                f.write(b'0')
+            os.utime(os.path.join(tiles_dir, 'stale.png'), (0, 0))
+        last_used = os.path.join(registry.layer_cache_dir(old_layer), 'last_used')
+        os.utime(last_used, (0, 0))
+
+        # Expired tiles are removed.
+        registry.REGISTRY_MAPPROXY_CACHE_TTL = 3600
+        registry.prune_tile_cache()
+        assert not os.path.exists(os.path.join(tiles_dir, 'stale.png'))
+        assert os.path.exists(os.path.join(tiles_dir, 'fresh.png'))
+
+        # The least recently used layer is removed to fit the quota.
+        registry.REGISTRY_MAPPROXY_CACHE_QUOTA_MB = 1
+        registry.prune_tile_cache()
+        assert not os.path.exists(registry.layer_cache_dir(old_layer))
+        assert os.path.exists(registry.layer_cache_dir(new_layer))
+    finally:
+        (registry.MAPPROXY_CACHE_DIR, registry.REGISTRY_MAPPROXY_CACHE_TYPE,
+         registry.REGISTRY_MAPPROXY_CACHE_TTL, registry.REGISTRY_MAPPROXY_CACHE_QUOTA_MB) = settings
+
+
 def test_reindex_records(client):
     message, status = registry.delete_index(catalog_slug)
     assert 200 == status
@@ -874,6 +1274,74 @@ def test_reindex_records(client):
     assert len(layers_list) - 1 == results['a.matchDocs']
 
 
+def test_reindex_progress(tmpdir):
+    checkpoint_file = str(tmpdir.join('reindex.checkpoint'))
+    progress = registry.ReindexProgress(catalog_slug, checkpoint_file)
+    progress.batch_done(1, 'record-2', 10, 0)
+    assert not os.path.exists(checkpoint_file)
+    progress.batch_done(0, 'record-1', 10, 0)
+    progress.batch_done(2, 'record-3', 10, 1)
+    progress.batch_done(3, 'record-4', 10, 0)
+    # The checkpoint stops before the batch with a failed document.
+    with open(checkpoint_file) as f:
+        assert 'record-2' == f.read()
+    assert (39, 1) == (progress.indexed, progress.failed)
+
+    progress.close()
+    assert os.path.exists(checkpoint_file)
+
+    progress = registry.ReindexProgress(catalog_slug, checkpoint_file)
+    progress.batch_done(0, 'record-5', 10, 0)
+    progress.close()
+    assert not os.path.exists(checkpoint_file)
+
+
+def test_update_aliases():
+    class FlakyES(object):
+        def __init__(self, failures):
+            self.failures = failures
+            self.posts = 0
+
+        def post(self, path, data=None):
+            self.posts += 1
+            if self.posts <= self.failures:
+                raise requests.exceptions.ConnectionError('connection reset')
+            return {'acknowledged': True}
+
+    actions = [{'add': {'index': 'test_v2', 'alias': 'test'}}]
+    es = FlakyES(failures=2)
+    assert {'acknowledged': True} == registry.update_aliases(es, actions, delay=0)
+    assert 3 == es.posts
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        registry.update_aliases(FlakyES(failures=3), actions, delay=0)
+
+
+def test_reindex_alias_swap(client):
+    es, _ = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    assert ['{0}_v1'.format(catalog_slug)] == registry.catalog_indices(catalog_slug, es)
+
+    # A merge that times out does not stop the alias swap.
+    merge_timeout = registry.REGISTRY_REINDEX_MERGE_TIMEOUT
+    registry.REGISTRY_REINDEX_MERGE_TIMEOUT = 0.000001
+    try:
+        new_index = registry.reindex_catalog(catalog_slug)
+    finally:
+        registry.REGISTRY_REINDEX_MERGE_TIMEOUT = merge_timeout
+    assert '{0}_v2'.format(catalog_slug) == new_index
+    assert [new_index] == registry.catalog_indices(catalog_slug, es)
+    assert [2] == registry.catalog_versions(catalog_slug, es)
+
+    es.post('/_refresh')
+    response = client.get(catalog_search_api, default_params)
+    assert 200 == response.status_code
+    results = json.loads(response.content.decode('utf-8'))
+    assert len(layers_list) - 1 == results['a.matchDocs']
+
+    settings = es.get('{0}/_settings'.format(new_index))[new_index]['settings']['index']
+    assert '-1' != settings.get('refresh_interval')
+
+
 def test_vcaps(client):
     SAMPLE_VCAPS = r"""{
         "searchly": [
@@ -999,6 +1467,220 @@ def test_utilities(client):
     check_color = registry.check_image(img)
     assert 1 == check_color
 
+    # Thresholds do not depend on the image size.
+    img = Image.new('L', (400, 300), 255)
+    img.putpixel((20, 20), 172)
+    img.putpixel((30, 70), 240)
+    img.putpixel((120, 100), 120)
+    check_color = registry.check_image(img)
+    assert 1 == check_color
+
+    # Images are scored in batches, with or without NumPy.
+    good = Image.new('L', (400, 300), 255)
+    for x in range(0, 400, 4):
+        for y in range(0, 300, 2):
+            good.putpixel((x, y), (x + y) % 256)
+    error = Image.new('L', (400, 300), 255)
+    for x in range(10, 200):
+        error.putpixel((x, 150), 0)
+    assert [0, 1, 1] == registry.check_images([good, error, img])
+    stats = registry.image_stats([good, error])
+    assert 2 == stats[1].colors
+    assert stats[0].entropy > stats[1].entropy > 0
+
+    numpy = registry.numpy
+    registry.numpy = None
+    try:
+        assert [0, 1, 1] == registry.check_images([good, error, img])
+        for fallback, vectorized in zip(registry.image_stats([good, error]), stats):
+            assert fallback.colors == vectorized.colors
+            assert round(fallback.entropy, 6) == round(vectorized.entropy, 6)
+    finally:
+        registry.numpy = numpy
+
+
+def test_check_schedule():
+    now = time.time()
+
+    def check(hours_ago, check_color='0'):
+        timestamp = '{0}'.format(datetime.fromtimestamp(int(now - hours_ago * 3600)))
+        return {'valid_bbox': '0', 'valid_config': '0', 'valid_image': '0', 'check_color': check_color,
+                'timestamp': timestamp}
+
+    # Failing layers are checked every REGISTRY_CHECK_MIN_INTERVAL, reliable ones less often.
+    day = registry.REGISTRY_CHECK_MIN_INTERVAL * 3600
+    assert day == registry.check_interval([check(1, '1')], 100.0)
+    assert day < registry.check_interval([check(1)], 50.0) < registry.check_interval([check(1)], 90.0)
+    assert registry.REGISTRY_CHECK_MAX_INTERVAL * 3600 == registry.check_interval([check(1)], 100.0)
+
+    assert float('inf') == registry.check_priority([], None, now)
+    assert registry.check_priority([check(1)], 100.0, now) is None
+    failed = registry.check_priority([check(registry.REGISTRY_CHECK_MIN_INTERVAL * 2, '1')], 0.0, now)
+    assert 2.0 == round(failed, 3)
+
+    # Malformed checks are skipped.
+    assert 1 == len(registry.check_times([check(1), {'timestamp': 'yesterday'}, {}]))
+    assert float('inf') == registry.check_priority([{'timestamp': '2016-13-45 25:00:00'}], 100.0, now)
+
+    class ScrollES(object):
+        def __init__(self, hits):
+            self.pages = [hits, []]
+
+        def post(self, path, params=None, data=None):
+            return {'hits': {'hits': self.pages.pop(0)}, '_scroll_id': 'scroll'}
+
+    def hit(uuid, checks_list):
+        return {'_source': {'layer_identifier': uuid, 'source_host': 'a.com', 'checks_list': checks_list,
+                            'reliability_rate': 0.0}}
+
+    # The checks of a layer copied in two catalogs are counted once in the budget of its server.
+    hits = [hit('checked', [check(1, '1')]), hit('checked', [check(1, '1')]), hit('new', [])]
+    assert ['new'] == registry.schedule_checks(ScrollES(hits), 'catalog', budget=2, now=now)
+
+
+def test_es_client_pool():
+    es, version = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    same_es, same_version = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    assert es is same_es
+    assert version == same_version
+
+    registry.es_reset()
+    new_es, _ = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    assert new_es is not es
+
+    # Slow requests get their own client, without read timeout.
+    slow_es = registry.es_client(registry.REGISTRY_SEARCH_URL, read_timeout=None)['es']
+    assert slow_es is not new_es
+    assert slow_es is registry.es_client(registry.REGISTRY_SEARCH_URL, read_timeout=None)['es']
+
+
+def test_index_queue():
+    queue_catalog = 'queue_test'
+    registry.create_index(queue_catalog)
+
+    queue = registry.IndexQueue(batch_size=2, flush_interval=0)
+    for i in range(3):
+        queue.put(queue_catalog, {'title': 'queued layer {0}'.format(i), 'layer_identifier': str(i)})
+    # The first two documents are sent as soon as the batch is full.
+    assert 2 == queue.indexed
+    assert 1 == len(queue.pending)
+
+    queue.flush()
+    assert 3 == queue.indexed
+    assert 0 == len(queue.failed)
+
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    es_client.post('/_refresh')
+    assert 3 == es_client.get('{0}/_search'.format(queue_catalog))['hits']['total']
+
+    registry.delete_index(queue_catalog)
+
+
+def test_migrate_index_ids():
+    migrate_catalog = 'migrate_test'
+    registry.create_index(migrate_catalog)
+    es_client = rawes.Elastic(registry.REGISTRY_SEARCH_URL)
+    for i in range(3):
+        es_client.put('{0}/layer/old{1}'.format(migrate_catalog, i),
+                      data={'title': 'old layer {0}'.format(i), 'layer_identifier': 'uuid{0}'.format(i)})
+    es_client.post('/_refresh')
+
+    class RejectingIndex(object):
+        """Rejects the index actions of a _bulk request for uuid0."""
+        def __init__(self, es):
+            self.es = es
+
+        def __getattr__(self, name):
+            return getattr(self.es, name)
+
+        def post(self, path, **kwargs):
+            response = self.es.post(path, **kwargs)
+            if path == '_bulk':
+                for item in response['items']:
+                    if item.get('index', {}).get('_id') == 'uuid0':
+                        item['index'].update({'status': 400, 'error': 'rejected'})
+                        response['errors'] = True
+            return response
+
+    migrated, failed = registry.migrate_index_ids(migrate_catalog, es=RejectingIndex(es_client))
+    assert (2, 1) == (migrated, failed)
+    es_client.post('/_refresh')
+    ids = [hit['_id'] for hit in es_client.get('{0}/_search'.format(migrate_catalog))['hits']['hits']]
+    # The old document of a rejected layer is kept.
+    assert 'old0' in ids
+    assert 'old1' not in ids and 'uuid1' in ids
+
+    assert (1, 0) == registry.migrate_index_ids(migrate_catalog)
+    es_client.post('/_refresh')
+    ids = [hit['_id'] for hit in es_client.get('{0}/_search'.format(migrate_catalog))['hits']['hits']]
+    assert ['uuid0', 'uuid1', 'uuid2'] == sorted(ids)
+
+    # Layers are deleted by their uuid.
+    queue = registry.IndexQueue(batch_size=10, flush_interval=0)
+    queue.delete(migrate_catalog, 'uuid1')
+    queue.flush()
+    assert 0 == len(queue.failed)
+    es_client.post('/_refresh')
+    ids = [hit['_id'] for hit in es_client.get('{0}/_search'.format(migrate_catalog))['hits']['hits']]
+    assert ['uuid0', 'uuid2'] == sorted(ids)
+
+    registry.delete_index(migrate_catalog)
+
+
+def test_delete_index_versions():
+    versions_catalog = 'versions_test'
+    es, _ = registry.es_connect(registry.REGISTRY_SEARCH_URL)
+    registry.create_index(versions_catalog)
+    # An interrupted rebuild leaves a versioned index without the catalog alias.
+    registry.create_index(versions_catalog, index_version=2, alias=False)
+    assert [1, 2] == registry.catalog_versions(versions_catalog, es)
+
+    message, status = registry.delete_index(versions_catalog)
+    assert 200 == status
+    assert [] == registry.catalog_versions(versions_catalog, es)
+
+
+def test_catalog_cache():
+    cache_catalog = 'cache_test'
+    registry.invalidate_catalogs()
+    assert cache_catalog not in registry.list_catalogs()
+
+    # Creating and removing catalogs refreshes the cached list.
+    registry.create_index(cache_catalog)
+    assert cache_catalog in registry.list_catalogs()
+    assert registry.check_index_exists(cache_catalog)
+
+    registry.delete_index(cache_catalog)
+    assert cache_catalog not in registry.list_catalogs()
+    assert not registry.check_index_exists(cache_catalog)
+
+    # Missing catalogs are remembered for a while instead of reading _aliases again.
+    assert registry.catalog_recently_missing(cache_catalog)
+    updated = registry.CATALOG_CACHE[registry.REGISTRY_SEARCH_URL]['updated']
+    assert not registry.check_index_exists(cache_catalog)
+    assert updated == registry.CATALOG_CACHE[registry.REGISTRY_SEARCH_URL]['updated']
+
+
+def test_search_cache(tmpdir):
+    caches = [registry.MemorySearchCache(maxsize=2),
+              registry.SQLiteSearchCache(path=str(tmpdir.join('search.db')), maxsize=2)]
+    for cache in caches:
+        key = registry.search_cache_key({'q_text': 'water'}, 'catalog', cache.generation('catalog'))
+        assert cache.get(key) is None
+        cache.set(key, '{"a.matchDocs": 1}')
+        assert cache.get(key) == '{"a.matchDocs": 1}'
+
+        # Writes to the catalog move its generation, so the old key is not used anymore.
+        cache.bump('catalog')
+        assert cache.generation('catalog') == 1
+        assert key != registry.search_cache_key({'q_text': 'water'}, 'catalog', cache.generation('catalog'))
+
+        # Least recently used entries are evicted.
+        cache.set('b', 'b')
+        cache.set('c', 'c')
+        assert cache.get(key) is None
+        assert cache.get('c') == 'c'
+
 
 def test_bad_mapproxy_config(client):
     with pytest.raises(registry.ConfigurationError) as excinfo:
@@ -1006,17 +1688,26 @@ def test_bad_mapproxy_config(client):
     assert 'invalid configuration' in str(excinfo.value)
 
 
-def test_check_layers():
+def test_check_layers(tmpdir):
     layer_uuid = 'f28ad41b-b91f-4d5d-a7c3-4b17dfaa5170'
     layer = registry.layer_from_csw(layer_uuid)
     _, yaml_config = registry.get_mapproxy(layer)
-    valid_bbox, valid_config, valid_image, check_color = registry.check_layer(layer_uuid)
+    archive_path = str(tmpdir.join('checks.zip'))
+    archive = registry.ConfigArchive(archive_path)
+    valid_bbox, valid_config, valid_image, check_color = registry.check_layer(layer_uuid, archive=archive)
+    archive.close()
     assert 0 == valid_bbox
     assert 0 == valid_config
     assert 0 == valid_image
     assert 1 == check_color
 
-    # Verify that recently created file exist in yml file.
+    # Checks do not write files, the configuration is only kept in the archive.
+    assert not os.path.exists('yml')
+    with zipfile.ZipFile(archive_path) as zip_file:
+        assert ['{0}.yml'.format(layer_uuid)] == zip_file.namelist()
+        assert yaml.load(yaml_config) == yaml.load(zip_file.read('{0}.yml'.format(layer_uuid)))
+
+    # Configurations can still be written one by one.
     valid_config = registry.check_config(layer_uuid, yaml_config, 'yml')
     assert 0 == valid_config
 
@@ -1081,6 +1772,52 @@ def test_check_layers():
     valid_config = registry.check_config('wrong_uuid', wrong_yml, 'yml')
     assert 1 == valid_config
 
+    # Layers are checked concurrently, in the format read by reliability.
+    results = dict((result[0], result[1:5]) for result in registry.check_layers([layer_uuid + '\n', 'wrong_uuid']))
+    assert (0, 0, 0, 1) == results[layer_uuid]
+    assert (1, 1, 1, 1) == results['wrong_uuid']
+
+    # Layers with an HTML error page in their metadata fail the configuration check.
+    class HTMLErrorLayer(object):
+        title_alternate = '<style>h1 { font-weight:normal; }</style>'
+
+        def __getattr__(self, name):
+            return getattr(layer, name)
+
+    real_layer_from_csw = registry.layer_from_csw
+    registry.layer_from_csw = lambda uuid: HTMLErrorLayer()
+    try:
+        results = list(registry.check_layers([layer_uuid]))
+    finally:
+        registry.layer_from_csw = real_layer_from_csw
+    assert (1, 1, 1, 1) == results[0][1:5]
+
+    # Layers of a busy server wait for a slot by uuid.
+    limiter = registry.NetlocLimiter(concurrency=1, rate=0)
+    results = list(registry.check_layers([layer_uuid] * 3, workers=3, limiter=limiter))
+    assert [(0, 0, 0, 1)] * 3 == [result[1:5] for result in results]
+    assert not limiter.active and not limiter.deferred
+
+
+def test_netloc_limiter():
+    limiter = registry.NetlocLimiter(concurrency=2, rate=0)
+    assert 0 == limiter.acquire('a.com', 'task 1')
+    assert 0 == limiter.acquire('a.com', 'task 2')
+    assert 0 == limiter.acquire('b.com', 'task 3')
+
+    # A busy server defers its tasks to the next release.
+    assert limiter.acquire('a.com', 'task 4') is None
+    assert ('task 4', 0) == limiter.release('a.com')
+    assert (None, None) == limiter.release('a.com')
+    assert (None, None) == limiter.release('a.com')
+    assert {'b.com': 1} == limiter.active
+
+    # Requests to a server are spaced by its rate.
+    limiter = registry.NetlocLimiter(concurrency=10, rate=10)
+    waits = [limiter.acquire('a.com', None) for _ in range(3)]
+    assert [0, 0.1, 0.2] == [round(wait, 1) for wait in waits]
+    assert 0 == limiter.acquire('b.com', None)
+
 
 def test_clear_records(client):
     response = client.delete('/catalog/{0}/csw'.format(catalog_slug))